@@ -1,15 +1,18 @@
 from .base import EmailBuilder
 from .mixins import LocalizationMixin, ContextMixin, SiteMixin
 from .mixins import HtmlAndTextTemplateMixin, ContextProcessorMixin
+from .mixins import PersonalizedTemplateMixin, InlineImagesMixin
 from .utils import build_absolute_url
 
 
 __all__ = (
     'ClassyMail', 'EmailBuilder', 'LocalizationMixin', 'ContextMixin',
     'SiteMixin', 'HtmlAndTextTemplateMixin', 'ContextProcessorMixin',
-    'build_absolute_url',
+    'PersonalizedTemplateMixin', 'InlineImagesMixin', 'build_absolute_url',
 )
 
+default_app_config = 'classymail.apps.ClassyMailConfig'
+
 
 class ClassyMail(LocalizationMixin, HtmlAndTextTemplateMixin, SiteMixin,
         ContextProcessorMixin, EmailBuilder):
@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+from .conf import get_config
+
+
+class ClassyMailConfig(AppConfig):
+    """
+    Runs `classymail.warmup.warmup()` at startup if CLASSYMAIL_WARMUP setting
+    is True (Django >= 1.7).
+    """
+    name = 'classymail'
+
+    def ready(self):
+        if get_config().WARMUP:
+            from .warmup import warmup
+            warmup()
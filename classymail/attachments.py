@@ -0,0 +1,164 @@
+"""
+classymail.attachments
+~~~~~~~~~~~~~~~~~~~~~~
+
+Attachments which are read only when the message is built and encoded to
+MIME only once.
+
+Django keeps content of every attachment in memory and encodes it again for
+every message. Return `FileAttachment` or `BufferAttachment` instances from
+`EmailBuilder.get_attachments()` instead - when the same instance is shared
+by many messages (for example a class attribute) the file is read and
+base64-encoded once and the encoded part is reused by all of them::
+
+    class ReportMail(ClassyMail):
+        attachments = [FileAttachment('/srv/reports/terms.pdf')]
+
+Encoded parts are also kept in a cache keyed by a hash of the content (and
+bounded by total size of encoded parts), so attachments with identical
+content - even passed as django's (filename, content, mimetype) tuples - are
+encoded only once.
+"""
+import hashlib
+import mimetypes
+import os
+import threading
+from email.mime.image import MIMEImage
+from django.core import mail
+from .cache import LRUCache
+
+
+DEFAULT_MIMETYPE = 'application/octet-stream'
+
+#: Maximum total size (in bytes) of encoded attachments kept in memory.
+ATTACHMENT_CACHE_BYTES = 32 * 1024 * 1024
+
+#: Maximum total size (in bytes) of encoded inline images kept in memory.
+IMAGE_CACHE_BYTES = 8 * 1024 * 1024
+
+_parts = LRUCache(maxsize=None, maxbytes=ATTACHMENT_CACHE_BYTES)
+_images = LRUCache(maxsize=None, maxbytes=IMAGE_CACHE_BYTES)
+
+
+def create_mime_part(filename, content, mimetype=None, encoding=None):
+    """
+    Returns MIME part for attachment, exactly like django creates it.
+    """
+    message = mail.EmailMessage()
+    message.encoding = encoding
+    return message._create_attachment(filename, content, mimetype)
+
+
+def get_mime_part(filename, content, mimetype=None, encoding=None):
+    """
+    Returns MIME part for attachment, reusing part encoded for identical
+    content if it's still in the cache.
+    """
+    data = content.encode('utf-8') if isinstance(content, unicode) \
+        else content
+    key = (hashlib.sha1(data).hexdigest(), len(data), filename, mimetype,
+           encoding)
+    part = _parts.get(key)
+    if part is None:
+        part = create_mime_part(filename, content, mimetype, encoding)
+        _parts.set(key, part, len(part.get_payload()))
+    return part
+
+
+def get_inline_image(path):
+    """
+    Returns MIME part of image at `path` (with Content-ID header) to be
+    referenced from html as ``cid:``.
+
+    Parts are cached by path and modification time of the file.
+    """
+    key = (path, os.path.getmtime(path))
+    part = _images.get(key)
+    if part is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+        mimetype = mimetypes.guess_type(path)[0] or ''
+        subtype = mimetype.split('/')[1] if mimetype.startswith('image/') \
+            else None
+        part = MIMEImage(data, subtype)
+        part['Content-ID'] = '<%s@classymail>' % hashlib.sha1(data).hexdigest()
+        part.add_header('Content-Disposition', 'inline',
+                        filename=os.path.basename(path))
+        _images.set(key, part, len(part.get_payload()))
+    return part
+
+
+class Attachment(object):
+    """
+    Base class for lazy attachments. Subclasses have to implement `read()`.
+    """
+    def __init__(self, filename=None, mimetype=None):
+        if mimetype is None and filename:
+            mimetype = mimetypes.guess_type(filename)[0]
+        self.filename = filename
+        self.mimetype = mimetype or DEFAULT_MIMETYPE
+        self._part = None
+        self._lock = threading.Lock()
+
+    def read(self):
+        """
+        Returns content of the attachment.
+        """
+        raise NotImplementedError
+
+    def get_mime_part(self):
+        """
+        Returns encoded MIME part, reading and encoding content only once.
+        """
+        if self._part is None:
+            with self._lock:
+                if self._part is None:
+                    self._part = get_mime_part(
+                        self.filename, self.read(), self.mimetype)
+        return self._part
+
+
+class FileAttachment(Attachment):
+    """
+    Attachment read from file at `path`.
+    """
+    def __init__(self, path, filename=None, mimetype=None):
+        if filename is None:
+            filename = os.path.basename(path)
+        super(FileAttachment, self).__init__(filename, mimetype)
+        self.path = path
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+
+class BufferAttachment(Attachment):
+    """
+    Attachment with content from a buffer (string, memoryview or mmap).
+    """
+    def __init__(self, buffer, filename=None, mimetype=None):
+        super(BufferAttachment, self).__init__(filename, mimetype)
+        self.buffer = buffer
+
+    def read(self):
+        if hasattr(self.buffer, 'tobytes'):  # memoryview
+            return self.buffer.tobytes()
+        return self.buffer[:]
+
+
+def resolve_attachments(attachments):
+    """
+    Replaces lazy attachments and (filename, content, mimetype) tuples with
+    their (cached) MIME parts.
+    """
+    if not attachments:
+        return attachments
+    resolved = []
+    for attachment in attachments:
+        if isinstance(attachment, Attachment):
+            attachment = attachment.get_mime_part()
+        elif isinstance(attachment, tuple):
+            attachment = get_mime_part(*attachment)
+        resolved.append(attachment)
+    return resolved
@@ -5,8 +5,135 @@ classymail.base
 Module which defines `EmailBuilder` class - a base class for building e-mail
 messages.
 """
+import time
+import weakref
+from collections import namedtuple
+from functools import partial
+from itertools import islice
 from django.core import mail
 from django.utils import encoding
+from .attachments import resolve_attachments
+from .cache import LRUCache
+from .message import RawMessage
+from .tracing import traced
+from .utils import close_db_connections
+
+
+class SendResult(namedtuple('SendResult', 'builder message error')):
+    """
+    Result of sending a single message using `EmailBuilder.send_many()`.
+
+    `message` is None if message could not be built and `error` holds an
+    exception raised while building or sending the message.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_builder(cls, builder, build=None):
+        """
+        Builds a message using `build` callable (`builder.build` by default)
+        and returns the result.
+        """
+        try:
+            message = (build or builder.build)()
+        except Exception as e:
+            return cls(builder, None, e)
+        return cls(builder, message, None)
+
+    @property
+    def sent(self):
+        return self.error is None
+
+
+def send_message(message, connection=None):
+    """
+    Sends `message` using `connection` (or its own connection) and returns
+    it, so tracers can report its size.
+    """
+    if connection is None:
+        message.send()
+    else:
+        connection.send_messages([message])
+    return message
+
+
+def send_results(results, connection):
+    """
+    Sends messages of successfully built `SendResult` instances using
+    already opened `connection`.
+
+    Every message is passed to `connection.send_messages()` separately, so
+    an error (like a rejected recipient) marks only that message as failed.
+    Returns updated list of results.
+    """
+    sent = []
+    for result in results:
+        if result.sent and not result.message.recipients():
+            result = result._replace(
+                error=ValueError("Message has no recipients."))
+        elif result.sent:
+            try:
+                traced('send', result.builder, send_message, result.message,
+                       connection)
+            except Exception as e:
+                result = result._replace(error=e)
+        sent.append(result)
+    return sent
+
+
+#: Maximum total size (in bytes) of built messages kept in memory.
+BUILD_CACHE_BYTES = 16 * 1024 * 1024
+
+# serialized messages built by builders with a build cache key
+_built = LRUCache(maxsize=None, maxbytes=BUILD_CACHE_BYTES)
+
+
+def _get_pool(max_workers):
+    if not max_workers:
+        return None
+    from multiprocessing.pool import ThreadPool
+    return ThreadPool(max_workers)
+
+
+def _build_in_thread(builder_class, builders, preserve_order):
+    try:
+        return builder_class.build_chunk(builders, preserve_order)
+    finally:
+        # every thread has its own database connections
+        close_db_connections()
+
+
+# EmailBuilder subclasses by dotted path
+_registry = weakref.WeakValueDictionary()
+
+
+def get_builders():
+    """
+    Returns dictionary of all EmailBuilder subclasses defined so far, keyed by
+    dotted path.
+    """
+    return dict(_registry)
+
+
+class EmailBuilderMeta(type):
+    """
+    Metaclass which registers every EmailBuilder subclass.
+    """
+    def __init__(cls, name, bases, attrs):
+        super(EmailBuilderMeta, cls).__init__(name, bases, attrs)
+        _registry['%s.%s' % (cls.__module__, name)] = cls
+
+
+def chunks(iterable, size):
+    """
+    Splits iterable into lists of at most `size` items.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 class EmailBuilder(object):
@@ -26,7 +153,14 @@ class EmailBuilder(object):
     `get_message()` method. You shouldn't override `build()` method unless you
     want to do some kind of isolation (like changing timezone or language for
     the time of building e-mail message).
+
+    Builders keep state of the message being built (like template context),
+    so a single builder must not be built by many threads at once. Different
+    builders can be built concurrently - active language and timezone are
+    local to every thread and shared caches are thread-safe.
     """
+    __metaclass__ = EmailBuilderMeta
+
     to = None
     cc = None
     bcc = None
@@ -37,6 +171,8 @@ class EmailBuilder(object):
     body = ''
     attachments = None
     mail_class = mail.EmailMessage
+    prefetched = None
+    build_cache_timeout = 300
 
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
@@ -53,8 +189,26 @@ class EmailBuilder(object):
 
         Don't override this method unless you want to do some kind of isolation,
         like changing timezone or language for the time of building a message.
+
+        If `get_build_cache_key()` returns a key then the message is built
+        only once (for `build_cache_timeout` seconds) and a `RawMessage` is
+        returned.
         """
-        return self.get_message()
+        key = self.get_build_cache_key()
+        if key is None:
+            return traced('get_message', self, self.get_message)
+
+        key = (self.__class__, key)
+        cached = _built.get(key)
+        if cached is not None and cached[0] > time.time():
+            return cached[1].copy(connection=self.get_connection())
+
+        message = traced('get_message', self, self.get_message)
+        raw = RawMessage.from_message(message)
+        raw.refresh_headers = True
+        _built.set(key, (time.time() + self.build_cache_timeout, raw),
+                   len(raw.raw))
+        return raw.copy(connection=message.connection)
 
     @classmethod
     def send(cls, **kwargs):
@@ -62,10 +216,162 @@ class EmailBuilder(object):
         A shortcut which builds and sends message.
         """
         builder = cls(**kwargs)
-        builder.build().send()
+        cls.prefetch([builder])
+        message = builder.build()
+        traced('send', builder, send_message, message)
+
+    @classmethod
+    def send_later(cls, **kwargs):
+        """
+        Stores builder class and keyword arguments in the outbox (see
+        `classymail.outbox`), so the message is built and sent later by
+        ``manage.py classymail_drain``. Returns id of the outbox entry.
+        """
+        from .outbox import get_outbox
+        return get_outbox().put_builder(cls, kwargs)
+
+    @classmethod
+    def build_many(cls, kwargs_list, chunk_size=100, preserve_order=True,
+                   max_workers=None):
+        """
+        Builds a message for every dictionary of keyword arguments in
+        `kwargs_list`.
+
+        Messages are built lazily in chunks of `chunk_size` messages using
+        `build_chunk()` - this method returns a generator. If `max_workers`
+        is given every chunk is split between a pool of that many threads,
+        so builders waiting for database or other I/O don't block each
+        other.
+        """
+        pool = _get_pool(max_workers)
+        try:
+            for chunk in chunks(kwargs_list, chunk_size):
+                builders = [cls(**kwargs) for kwargs in chunk]
+                cls.prefetch(builders)
+                for result in cls._build_chunk(builders, preserve_order,
+                                               pool, max_workers):
+                    if result.error is not None:
+                        raise result.error
+                    yield result.message
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    @classmethod
+    def send_many(cls, kwargs_list, connection=None, chunk_size=100,
+                  preserve_order=True, max_workers=None):
+        """
+        Builds and sends a message for every dictionary of keyword arguments
+        in `kwargs_list` using a single connection.
+
+        Messages are built lazily in chunks of `chunk_size` messages and sent
+        one by one over the opened connection. Returns list of `SendResult`
+        instances in the same order as `kwargs_list` (unless `preserve_order`
+        is False). Messages are built in a pool of `max_workers` threads if given (see
+        `build_many()`).
+        """
+        if connection is None:
+            connection = mail.get_connection()
+
+        results = []
+        pool = _get_pool(max_workers)
+        opened = connection.open()
+        try:
+            for chunk in chunks(kwargs_list, chunk_size):
+                results.extend(cls._send_chunk(chunk, connection,
+                                               preserve_order, pool,
+                                               max_workers))
+        finally:
+            if opened:
+                connection.close()
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return results
+
+    @classmethod
+    def _send_chunk(cls, kwargs_list, connection, preserve_order, pool=None,
+                    max_workers=None):
+        builders, failed = [], {}
+        for index, kwargs in enumerate(kwargs_list):
+            try:
+                builders.append(cls(**kwargs))
+            except Exception as e:
+                failed[index] = SendResult(None, None, e)
+
+        try:
+            cls.prefetch(builders)
+        except Exception as e:
+            results = [SendResult(builder, None, e) for builder in builders]
+        else:
+            results = cls._build_chunk(builders, preserve_order, pool,
+                                       max_workers)
+        for index in sorted(failed):
+            results.insert(index, failed[index])
+        return send_results(results, connection)
+
+    @classmethod
+    def _build_chunk(cls, builders, preserve_order, pool=None,
+                     max_workers=None):
+        if pool is None or len(builders) < 2:
+            return cls.build_chunk(builders, preserve_order)
+        # one part of the chunk for every thread
+        size = -(-len(builders) // max_workers)
+        parts = pool.map(partial(_build_in_thread, cls,
+                                 preserve_order=preserve_order),
+                         list(chunks(builders, size)))
+        return [result for part in parts for result in part]
+
+    @classmethod
+    def prefetch(cls, builders):
+        """
+        Loads data needed by a chunk of builders at once.
+
+        Bulk sending methods call it for every chunk before building messages
+        (and before calling `get_language()` or `get_timezone()`) and
+        `send()` calls it with a single builder, so it can
+        be overridden to avoid querying database for every message
+        separately. Store loaded data in `prefetched` attribute of builders,
+        for example::
+
+            @classmethod
+            def prefetch(cls, builders):
+                profiles = Profile.objects.in_bulk(
+                    [builder.user.pk for builder in builders])
+                for builder in builders:
+                    builder.prefetched = profiles.get(builder.user.pk)
+        """
+
+    @classmethod
+    def build_chunk(cls, builders, preserve_order=True):
+        """
+        Builds messages for a list of builders and returns a list of
+        `SendResult` instances.
+
+        Bulk sending methods build messages chunk by chunk using this method,
+        so it can be overridden to build many messages at once more
+        efficiently. Results may be returned in different order than builders
+        if `preserve_order` is False.
+        """
+        return [SendResult.from_builder(builder) for builder in builders]
 
     # Methods meant to be overridden by subclasses
 
+    def get_build_cache_key(self):
+        """
+        Returns key identifying message built by this builder or None (the
+        default) if built messages shouldn't be cached.
+
+        The key has to change whenever the message would be different - it
+        should include all arguments of the builder (and active language if
+        it matters), for example::
+
+            def get_build_cache_key(self):
+                return (self.order.pk, self.order.modified)
+        """
+        return None
+
     def get_to(self):
         """
         Returns list of recipients for "To" header.
@@ -118,6 +424,9 @@ class EmailBuilder(object):
     def get_attachments(self):
         """
         Returns list of attachments or None.
+
+        Attachments can be `MIMEBase` instances, (filename, content, mimetype)
+        tuples or lazy attachments from `classymail.attachments`.
         """
         return self.attachments
 
@@ -126,6 +435,11 @@ class EmailBuilder(object):
         Returns the e-mail message.
         """
         kwargs = self.get_message_kwargs()
+        if (isinstance(self.mail_class, type) and
+                issubclass(self.mail_class, mail.EmailMessage)):
+            # django messages accept MIME parts, so attachments can be
+            # encoded once and shared between messages
+            kwargs['attachments'] = resolve_attachments(kwargs['attachments'])
         return self.mail_class(**kwargs)
 
     def get_message_kwargs(self):
@@ -0,0 +1,307 @@
+"""
+classymail.bench
+~~~~~~~~~~~~~~~~
+
+Benchmarks for the message building pipeline. Run them with::
+
+    python -m classymail.bench --messages 100,1000 --sizes 10,100 \\
+        --output results.json
+
+Every benchmark is run in a separate process for every combination of
+message count and template size, and reports messages per second, p50/p99
+latency and memory usage: peak size of allocated memory (only where
+tracemalloc is available) and maximum resident set size of the process.
+Results saved with ``--output`` can be compared between releases.
+
+If DJANGO_SETTINGS_MODULE is not set minimal settings are configured.
+"""
+import json
+import multiprocessing
+import optparse
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:  # Python < 3.4
+    tracemalloc = None
+
+import django
+from django.conf import settings
+
+
+STYLESHEET = """
+<style>
+body { font-family: Arial, sans-serif; color: #333; }
+h1 { font-size: 20px; color: #111; }
+p.content { margin: 0 0 10px; line-height: 1.4; }
+a { color: #06c; text-decoration: none; }
+a:hover { text-decoration: underline; }
+</style>
+"""
+
+
+def configure_settings():
+    """
+    Configures minimal settings needed to run benchmarks.
+    """
+    if settings.configured or os.environ.get('DJANGO_SETTINGS_MODULE'):
+        return
+    settings.configure(
+        INSTALLED_APPS=('classymail',),
+        CLASSYMAIL_DOMAIN='example.com',
+        EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+    )
+    if hasattr(django, 'setup'):  # Django >= 1.7
+        django.setup()
+
+
+def write_templates(directory, size):
+    """
+    Writes benchmark templates with `size` paragraphs/links to `directory`.
+    """
+    paragraph = '<p class="content">Paragraph {{ forloop.counter }}.</p>'
+    link = "<a href=\"{% build_absolute_url path='/item/' %}\">Link</a>"
+    templates = {
+        'bench.txt': 'Hello {{ name }}!\n' + 'Paragraph.\n' * size,
+        'bench.html': ('<html><head>' + STYLESHEET + '</head><body>'
+                       '<h1>Hello {{ name }}!</h1>' + paragraph * size +
+                       '</body></html>'),
+        'bench_links.html': ('{% load classymail_tags %}<html><head>' +
+                             STYLESHEET + '</head><body>' + link * size +
+                             '</body></html>'),
+    }
+    for name, content in templates.items():
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(content)
+
+
+def _processor(builder):
+    return {'company': 'Example', 'footer': 'Footer'}
+
+
+def bench_email_builder(size):
+    from classymail import EmailBuilder
+    body = 'Lorem ipsum dolor sit amet.\n' * size
+
+    def build(i):
+        EmailBuilder(to=['user%d@example.com' % i], subject='Benchmark',
+                     body=body).build()
+    return build, {}
+
+
+def _classymail(html_template_name, **overrides):
+    from django.contrib.sites.models import Site
+    from classymail import ClassyMail
+    site = Site(domain='example.com', name='example.com')
+
+    def build(i):
+        ClassyMail(to=['user%d@example.com' % i], subject='Benchmark',
+                   site=site, html_template_name=html_template_name,
+                   text_template_name='bench.txt',
+                   extra_context={'name': 'User %d' % i}).build()
+    return build, overrides
+
+
+def bench_classymail_no_inlining(size):
+    return _classymail('bench.html', CLASSYMAIL_CSS_INLINE_FUNCTION=None)
+
+
+def bench_classymail_premailer(size):
+    return _classymail('bench.html',
+                       CLASSYMAIL_CSS_INLINE_FUNCTION='premailer.transform')
+
+
+def bench_classymail_inline(size):
+    return _classymail(
+        'bench.html',
+        CLASSYMAIL_CSS_INLINE_FUNCTION='classymail.inline.transform')
+
+
+def bench_url_tags(size):
+    return _classymail('bench_links.html',
+                       CLASSYMAIL_CSS_INLINE_FUNCTION=None)
+
+
+def bench_context_processors(size):
+    from classymail import ContextProcessorMixin
+
+    def build(i):
+        ContextProcessorMixin().get_context_data()
+    path = '%s._processor' % __name__
+    return build, {'CLASSYMAIL_CONTEXT_PROCESSORS': [path] * size}
+
+
+BENCHMARKS = (
+    ('email_builder', bench_email_builder),
+    ('classymail_no_inlining', bench_classymail_no_inlining),
+    ('classymail_premailer', bench_classymail_premailer),
+    ('classymail_inline', bench_classymail_inline),
+    ('url_tags', bench_url_tags),
+    ('context_processors', bench_context_processors),
+)
+
+
+def percentile(values, q):
+    """
+    Returns q-th percentile (0 <= q <= 1) of sorted values.
+    """
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def _max_rss():
+    """
+    Returns maximum resident set size of the process in kilobytes.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X and in kilobytes elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _memory_start():
+    if tracemalloc is not None:
+        tracemalloc.start()
+
+
+def _memory_stop():
+    """
+    Returns peak traced memory in kilobytes (None without tracemalloc).
+    """
+    if tracemalloc is None:
+        return None
+    peak = tracemalloc.get_traced_memory()[1] // 1024
+    tracemalloc.stop()
+    return peak
+
+
+def run_benchmark(setup, messages, size):
+    """
+    Runs a single benchmark and returns a dictionary with results.
+
+    Reported maximum RSS is the one of the current process, so benchmarks
+    should be run in a fresh process (see `run_in_child`).
+    """
+    from django.test.utils import override_settings
+
+    build, overrides = setup(size)
+    with override_settings(**overrides):
+        build(0)  # warm up caches, imports etc.
+        timings = []
+        _memory_start()
+        started = time.time()
+        for i in range(messages):
+            start = time.time()
+            build(i)
+            timings.append(time.time() - start)
+        total = time.time() - started
+        peak_memory = _memory_stop()
+
+    timings.sort()
+    return {
+        'messages': messages,
+        'size': size,
+        'total_seconds': total,
+        'messages_per_second': messages / total if total else None,
+        'p50_ms': percentile(timings, 0.5) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000,
+        'peak_memory_kb': peak_memory,
+        'max_rss_kb': _max_rss(),
+    }
+
+
+def run_in_child(setup, messages, size):
+    """
+    Runs a single benchmark in a child process, so its maximum RSS isn't
+    affected by benchmarks run before.
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(run_benchmark, (setup, messages, size))
+    finally:
+        pool.terminate()
+
+
+def run_benchmarks(messages=(100,), sizes=(10,), names=None):
+    """
+    Runs benchmarks (all or those listed in `names`) and returns results as
+    a dictionary which can be serialized to JSON.
+    """
+    from django.test.utils import override_settings
+    import classymail
+
+    results = []
+    directory = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            write_templates(directory, size)
+            with override_settings(TEMPLATE_DIRS=(directory,)):
+                for name, setup in BENCHMARKS:
+                    if names and name not in names:
+                        continue
+                    for count in messages:
+                        result = run_in_child(setup, count, size)
+                        result['name'] = name
+                        results.append(result)
+    finally:
+        shutil.rmtree(directory)
+
+    return {
+        'classymail': getattr(classymail, '__version__', None),
+        'django': django.get_version(),
+        'python': platform.python_version(),
+        'timestamp': time.time(),
+        'results': results,
+    }
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='python -m classymail.bench [options]')
+    parser.add_option('--messages', default='100',
+                      help='comma separated list of message counts')
+    parser.add_option('--sizes', default='10',
+                      help='comma separated list of template sizes')
+    parser.add_option('--benchmarks', default='',
+                      help='comma separated list of benchmarks to run '
+                           '(available: %s)' %
+                           ', '.join(name for name, setup in BENCHMARKS))
+    parser.add_option('--output', help='save results as JSON to this file')
+    options, args = parser.parse_args(argv)
+
+    configure_settings()
+    report = run_benchmarks(_int_list(options.messages),
+                            _int_list(options.sizes),
+                            [name for name in options.benchmarks.split(',')
+                             if name])
+
+    row = '%-24s %9s %6s %12s %10s %10s %12s %12s'
+    print(row % ('benchmark', 'messages', 'size', 'msgs/sec', 'p50 ms',
+                 'p99 ms', 'peak mem kB', 'max rss kB'))
+    for result in report['results']:
+        print(row % (result['name'], result['messages'], result['size'],
+                     '%.1f' % (result['messages_per_second'] or 0),
+                     '%.3f' % result['p50_ms'], '%.3f' % result['p99_ms'],
+                     result['peak_memory_kb'],
+                     result['max_rss_kb']))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+classymail.cache
+~~~~~~~~~~~~~~~~
+
+Small in-process caches used by ClassyMail to avoid repeating expensive work
+(like parsing stylesheets) for every message that is being built.
+"""
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:  # Python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe mapping which discards least recently used items
+    when it holds more than `maxsize` items or when total size of items is
+    bigger than `maxbytes` (if given).
+
+    Sizes of items are passed to `set()`. Items bigger than `maxbytes` are
+    not stored at all.
+    """
+    def __init__(self, maxsize=128, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.size = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        Returns value stored under `key` and marks it as recently used.
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value, size=0):
+        """
+        Stores `value` of given `size` under `key`, evicting least recently
+        used items if needed.
+        """
+        with self._lock:
+            self._remove(key)
+            if self.maxbytes is not None and size > self.maxbytes:
+                return
+            self._data[key] = value
+            self._sizes[key] = size
+            self.size += size
+            while ((self.maxsize is not None and
+                    len(self._data) > self.maxsize) or
+                   (self.maxbytes is not None and self.size > self.maxbytes)):
+                self._remove(next(iter(self._data)))
+
+    def _remove(self, key):
+        if key in self._data:
+            del self._data[key]
+            self.size -= self._sizes.pop(key)
+
+    def clear(self):
+        """
+        Removes all items from the cache.
+        """
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.size = 0
@@ -0,0 +1,119 @@
+"""
+classymail.conf
+~~~~~~~~~~~~~~~
+
+Snapshot of ClassyMail settings.
+
+Reading attributes of django's lazy settings object is not free, so
+ClassyMail reads CLASSYMAIL_* settings once and keeps them in a read-only
+`Config` object returned by `get_config()`::
+
+    from classymail.conf import get_config
+
+    if get_config().ALWAYS_SECURE:
+        ...
+
+The snapshot is built again when any CLASSYMAIL_* setting is changed using
+`override_settings` (or after `clear_config()` is called).
+"""
+from django.conf import settings
+
+
+#: Names of settings (without CLASSYMAIL_ prefix) and their default values.
+DEFAULTS = (
+    ('ALLOW_SECURE', None),
+    ('ALWAYS_SECURE', None),
+    ('CONTEXT_PROCESSORS', None),
+    ('CSS_INLINE_CACHE', None),
+    ('CSS_INLINE_CACHE_TIMEOUT', None),
+    ('CSS_INLINE_FUNCTION', 'premailer.transform'),
+    ('CSS_INLINER', None),
+    ('CSS_INLINER_OPTIONS', None),
+    ('DOMAIN', None),
+    ('OUTBOX', None),
+    ('OUTBOX_OPTIONS', None),
+    ('OVERRIDE_DOMAIN', None),
+    ('URL_FUNCTION', None),
+    ('WARMUP', False),
+)
+
+_config = []
+
+
+class Config(object):
+    """
+    Read-only snapshot of CLASSYMAIL_* settings.
+
+    Attributes are named like settings without the prefix (``DOMAIN`` for
+    CLASSYMAIL_DOMAIN).
+    """
+    __slots__ = tuple(name for name, default in DEFAULTS)
+
+    def __init__(self, **values):
+        for name, default in DEFAULTS:
+            object.__setattr__(self, name, values.pop(name, default))
+        if values:
+            raise TypeError("Unknown settings: %s" % ', '.join(values))
+
+    @classmethod
+    def from_settings(cls):
+        """
+        Returns snapshot of current settings.
+        """
+        values = {}
+        for name, default in DEFAULTS:
+            setting = 'CLASSYMAIL_%s' % name
+            if hasattr(settings, setting):
+                values[name] = getattr(settings, setting)
+        return cls(**values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Config is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("Config is read-only")
+
+    def __repr__(self):
+        return '<Config %s>' % ', '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self.__slots__)
+
+
+def clear_config(**kwargs):
+    """
+    Removes the snapshot, so it's built again by the next `get_config()`.
+    """
+    del _config[:]
+
+
+def _setting_changed(sender, setting, **kwargs):
+    if setting.startswith('CLASSYMAIL_'):
+        clear_config()
+
+
+def get_setting_changed_signal():
+    """
+    Returns django's `setting_changed` signal.
+
+    Before Django 1.8 it lives in django.test, which is expensive to import,
+    so receivers are connected only when caches are filled for the first
+    time (connecting the same receiver again does nothing).
+    """
+    try:
+        from django.core.signals import setting_changed
+    except ImportError:  # Django < 1.8
+        from django.test.signals import setting_changed
+    return setting_changed
+
+
+def get_config():
+    """
+    Returns `Config` with current values of CLASSYMAIL_* settings.
+    """
+    try:
+        return _config[0]
+    except IndexError:
+        get_setting_changed_signal().connect(
+            _setting_changed, dispatch_uid='classymail.conf')
+        config = Config.from_settings()
+        _config[:] = [config]
+        return config
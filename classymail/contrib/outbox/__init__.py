@@ -0,0 +1,8 @@
+"""
+classymail.contrib.outbox
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Database table used by `classymail.outbox.DatabaseOutbox`. Add this app to
+INSTALLED_APPS to use the default outbox.
+"""
+default_app_config = 'classymail.contrib.outbox.apps.OutboxConfig'
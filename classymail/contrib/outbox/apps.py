@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class OutboxConfig(AppConfig):
+    name = 'classymail.contrib.outbox'
+    label = 'classymail_outbox'
+    verbose_name = 'ClassyMail outbox'
@@ -0,0 +1,18 @@
+from django.db import models
+
+
+class OutboxMessage(models.Model):
+    """
+    A message waiting to be sent by ``manage.py classymail_drain`` (see
+    `classymail.outbox.DatabaseOutbox`).
+    """
+    payload = models.TextField()
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(db_index=True)
+    failed = models.BooleanField(default=False, db_index=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'classymail_outboxmessage'
+        ordering = ('id',)
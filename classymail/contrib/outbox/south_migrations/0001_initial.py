@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from south.db import db
+from south.v2 import SchemaMigration
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        db.create_table('classymail_outboxmessage', (
+            ('id', self.gf('django.db.models.fields.AutoField')(
+                primary_key=True)),
+            ('payload', self.gf('django.db.models.fields.TextField')()),
+            ('attempts', self.gf(
+                'django.db.models.fields.PositiveIntegerField')(default=0)),
+            ('available_at', self.gf('django.db.models.fields.DateTimeField')(
+                db_index=True)),
+            ('failed', self.gf('django.db.models.fields.BooleanField')(
+                default=False, db_index=True)),
+            ('last_error', self.gf('django.db.models.fields.TextField')(
+                blank=True)),
+            ('created_at', self.gf('django.db.models.fields.DateTimeField')(
+                auto_now_add=True, blank=True)),
+        ))
+        db.send_create_signal('outbox', ['OutboxMessage'])
+
+    def backwards(self, orm):
+        db.delete_table('classymail_outboxmessage')
+
+    models = {
+        'outbox.outboxmessage': {
+            'Meta': {'ordering': "('id',)", 'object_name': 'OutboxMessage',
+                     'db_table': "'classymail_outboxmessage'"},
+            'attempts': ('django.db.models.fields.PositiveIntegerField', [],
+                         {'default': '0'}),
+            'available_at': ('django.db.models.fields.DateTimeField', [],
+                             {'db_index': 'True'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [],
+                           {'auto_now_add': 'True', 'blank': 'True'}),
+            'failed': ('django.db.models.fields.BooleanField', [],
+                       {'default': 'False', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [],
+                   {'primary_key': 'True'}),
+            'last_error': ('django.db.models.fields.TextField', [],
+                           {'blank': 'True'}),
+            'payload': ('django.db.models.fields.TextField', [], {}),
+        }
+    }
+
+    complete_apps = ['outbox']
@@ -0,0 +1,333 @@
+"""
+classymail.inline
+~~~~~~~~~~~~~~~~~
+
+CSS inlining engine optimized for building many messages from the same
+templates.
+
+Contents of every ``<style>`` tag are parsed and their selectors compiled to
+XPath expressions only once - compiled stylesheets are kept in a bounded LRU
+cache keyed by a hash of the stylesheet, so following messages only have to
+apply already compiled rules. Stylesheets are split with a single pass
+tokenizer and declarations are not validated (unlike premailer, which uses
+cssutils). To use it instead of premailer set::
+
+    CLASSYMAIL_CSS_INLINER = 'classymail.inline.FastInliner'
+
+Inliners are classes with state kept between messages (see `BaseInliner`).
+Options from CLASSYMAIL_CSS_INLINER_OPTIONS are passed to the constructor.
+``CLASSYMAIL_CSS_INLINE_FUNCTION = 'classymail.inline.transform'`` uses
+the default `FastInliner` instance.
+"""
+import hashlib
+import re
+from cssselect import ExpressionError, HTMLTranslator, SelectorError
+from cssselect import parse as parse_selector
+from lxml import etree
+from .cache import LRUCache
+
+
+#: Maximum number of compiled stylesheets kept in memory.
+STYLESHEET_CACHE_SIZE = 128
+
+_translator = HTMLTranslator()
+_comment_re = re.compile(r'/\*.*?\*/', re.S)
+_important_re = re.compile(r'\s*!\s*important\s*$', re.I)
+_style_tag_re = re.compile(r'<style', re.I)
+_doctype_re = re.compile(r'\s*<!doctype', re.I)
+_dynamic_pseudo_re = re.compile(
+    r':(any-link|link|visited|hover|active|focus|focus-within|'
+    r'focus-visible|target)\b', re.I)
+
+#: Values of ``media`` attribute of ``<style>`` tags which are inlined.
+INLINED_MEDIA = ('all', 'screen')
+
+
+def _split(text, separator):
+    """
+    Splits text on separator, ignoring separators inside quotes, parentheses
+    and brackets.
+    """
+    parts, depth, quote, start = [], 0, None, 0
+    for i, char in enumerate(text):
+        if quote:
+            if char == quote and text[i - 1] != '\\':
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in '([':
+            depth += 1
+        elif char in ')]':
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts if part.strip()]
+
+
+def _iter_blocks(css):
+    """
+    Yields (prelude, body) pairs for all top level blocks of a stylesheet.
+
+    Body is None for at-rules without a block (like ``@import``).
+    """
+    depth, quote, start, prelude = 0, None, 0, None
+    for i, char in enumerate(css):
+        if quote:
+            if char == quote and css[i - 1] != '\\':
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '{':
+            if depth == 0:
+                prelude, start = css[start:i].strip(), i + 1
+            depth += 1
+        elif char == '}' and depth > 0:
+            depth -= 1
+            if depth == 0:
+                yield prelude, css[start:i]
+                start = i + 1
+        elif char == ';' and depth == 0:
+            if css[start:i].strip():
+                yield css[start:i].strip(), None
+            start = i + 1
+
+
+def parse_declarations(text):
+    """
+    Parses declarations (body of a css rule or a style attribute).
+
+    Returns list of (name, value, important) tuples.
+    """
+    declarations = []
+    for declaration in _split(text, ';'):
+        name, sep, value = declaration.partition(':')
+        if not sep or not name.strip():
+            continue
+        value, important = _important_re.subn('', value.strip())
+        declarations.append((name.strip().lower(), value, bool(important)))
+    return declarations
+
+
+class Stylesheet(object):
+    """
+    A compiled stylesheet.
+
+    `rules` is a list of (specificity, index, xpath, declarations) tuples and
+    `leftover` contains css which can't be inlined (at-rules, dynamic
+    pseudo-classes, pseudo-elements) and has to stay in a ``<style>`` tag.
+    """
+    def __init__(self, css):
+        self.rules = []
+        leftover = []
+        for prelude, body in _iter_blocks(_comment_re.sub('', css)):
+            if body is None:
+                leftover.append('%s;' % prelude)
+                continue
+            if prelude.startswith('@'):
+                leftover.append('%s {%s}' % (prelude, body))
+                continue
+
+            declarations = parse_declarations(body)
+            for selector in _split(prelude, ','):
+                compiled = self._compile_selector(selector)
+                if compiled is None:
+                    leftover.append('%s {%s}' % (selector, body.strip()))
+                elif declarations:
+                    specificity, xpath = compiled
+                    self.rules.append((specificity, len(self.rules), xpath,
+                                       declarations))
+        self.leftover = '\n'.join(leftover)
+
+    def _compile_selector(self, selector):
+        # dynamic pseudo-classes and pseudo-elements (:hover, ::before) can't
+        # be expressed with a style attribute, structural ones (:first-child)
+        # are compiled by cssselect
+        if _dynamic_pseudo_re.search(selector):
+            return None
+        try:
+            parsed = parse_selector(selector)
+            if len(parsed) != 1 or parsed[0].pseudo_element is not None:
+                return None
+            xpath = etree.XPath(_translator.selector_to_xpath(parsed[0]))
+        except (SelectorError, ExpressionError):
+            return None
+        return parsed[0].specificity(), xpath
+
+
+class _Style(object):
+    """
+    Collects declarations for a single element, honoring ``!important``.
+    """
+    def __init__(self):
+        self.names = []
+        self.values = {}
+        self.important = set()
+
+    def update(self, declarations):
+        for name, value, important in declarations:
+            if name in self.important and not important:
+                continue
+            if important:
+                self.important.add(name)
+            if name not in self.values:
+                self.names.append(name)
+            self.values[name] = value
+
+    def serialize(self):
+        return '; '.join('%s:%s' % (name, self.values[name])
+                         for name in self.names)
+
+
+class BaseInliner(object):
+    """
+    Base class for css inliners.
+
+    An inliner is created once (see `classymail.utils.get_css_inline_function`)
+    and used for all messages, so it can keep state - like compiled
+    stylesheets - between calls. Subclasses have to implement `inline()`.
+    """
+    def __init__(self, **options):
+        self.options = options
+
+    def __call__(self, html):
+        return self.inline(html)
+
+    def inline(self, html):
+        """
+        Returns html with styles moved to ``style`` attributes.
+        """
+        raise NotImplementedError
+
+    def warm(self, css):
+        """
+        Prepares stylesheet `css` so it's not processed again when inlining.
+        """
+
+
+class PremailerInliner(BaseInliner):
+    """
+    Inlines css using premailer. Options are passed to `premailer.Premailer`.
+    """
+    def inline(self, html):
+        from premailer import Premailer
+        return Premailer(html, **self.options).transform()
+
+
+class CachedInliner(BaseInliner):
+    """
+    Keeps results of `inline_fn` in a django `cache`, keyed by a hash of the
+    html, so identical html is inlined only once by all processes sharing
+    the cache.
+    """
+    def __init__(self, inline_fn, cache, key_prefix='classymail:inline',
+                 timeout=None, **options):
+        super(CachedInliner, self).__init__(**options)
+        self.inline_fn = inline_fn
+        self.cache = cache
+        self.key_prefix = key_prefix
+        self.timeout = timeout
+
+    def get_key(self, html):
+        digest = hashlib.sha1(html.encode('utf-8')).hexdigest()
+        return '%s:%s' % (self.key_prefix, digest)
+
+    def inline(self, html):
+        key = self.get_key(html)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.inline_fn(html)
+            if self.timeout is None:
+                self.cache.set(key, result)
+            else:
+                self.cache.set(key, result, self.timeout)
+        return result
+
+    def warm(self, css):
+        warm = getattr(self.inline_fn, 'warm', None)
+        if warm is not None:
+            warm(css)
+
+
+class FastInliner(BaseInliner):
+    """
+    Inliner which parses every stylesheet only once and keeps compiled
+    stylesheets in a LRU cache of `cache_size` items.
+    """
+    def __init__(self, cache_size=STYLESHEET_CACHE_SIZE, **options):
+        super(FastInliner, self).__init__(**options)
+        self.stylesheets = LRUCache(maxsize=cache_size)
+
+    def compile(self, css):
+        """
+        Returns compiled `Stylesheet` for given css, using the cache if
+        possible.
+        """
+        key = hashlib.sha1(css.encode('utf-8')).hexdigest()
+        stylesheet = self.stylesheets.get(key)
+        if stylesheet is None:
+            stylesheet = Stylesheet(css)
+            self.stylesheets.set(key, stylesheet)
+        return stylesheet
+
+    warm = compile
+
+    def inline(self, html):
+        """
+        Moves styles from ``<style>`` tags to ``style`` attributes of
+        elements.
+
+        Rules which can't be inlined are left in ``<style>`` tags. Like in
+        premailer, ``<style>`` tags with ``media`` other than ``all`` or
+        ``screen`` or with ``data-premailer="ignore"`` are left untouched.
+        """
+        if not _style_tag_re.search(html):
+            return html
+
+        root = etree.fromstring(html, etree.HTMLParser())
+        if root is None:
+            return html
+
+        rules = []
+        for block, element in enumerate(list(root.iter('style'))):
+            media = element.get('media')
+            if media and media.strip().lower() not in INLINED_MEDIA:
+                continue
+            if element.get('data-premailer') == 'ignore':
+                del element.attrib['data-premailer']
+                continue
+            stylesheet = self.compile(element.text or '')
+            for specificity, index, xpath, declarations in stylesheet.rules:
+                rules.append(((specificity, block, index), xpath,
+                              declarations))
+            if stylesheet.leftover:
+                element.text = stylesheet.leftover
+            else:
+                element.getparent().remove(element)
+        rules.sort(key=lambda rule: rule[0])
+
+        styles, elements = {}, []
+        for key, xpath, declarations in rules:
+            for element in xpath(root):
+                if element not in styles:
+                    styles[element] = _Style()
+                    elements.append(element)
+                styles[element].update(declarations)
+
+        for element in elements:
+            style = styles[element]
+            style.update(parse_declarations(element.get('style', '')))
+            element.set('style', style.serialize())
+
+        doctype = None
+        if _doctype_re.match(html):
+            doctype = root.getroottree().docinfo.doctype
+        return etree.tostring(root, method='html', encoding='unicode',
+                              doctype=doctype)
+
+
+#: Default `FastInliner` instance.
+transform = FastInliner()
+_stylesheets = transform.stylesheets
+compile_stylesheet = transform.compile
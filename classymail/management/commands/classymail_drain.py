@@ -0,0 +1,38 @@
+from optparse import make_option
+from django.core.management.base import CommandError, NoArgsCommand
+from classymail.outbox import OutboxWorker
+
+
+class Command(NoArgsCommand):
+    help = "Sends messages stored in the outbox."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--threads', type='int', default=4,
+                    help='Number of sending threads.'),
+        make_option('--batch-size', type='int', default=100,
+                    help='Number of messages sent using one connection '
+                         'at once.'),
+        make_option('--max-attempts', type='int', default=5,
+                    help='Number of attempts before a message is marked '
+                         'as failed.'),
+        make_option('--backoff', type='float', default=60,
+                    help='Delay (in seconds) before the first retry, '
+                         'doubled after every attempt.'),
+        make_option('--poll-interval', type='float', default=5,
+                    help='Seconds to wait when the outbox is empty.'),
+        make_option('--once', action='store_true', default=False,
+                    help='Exit when the outbox is empty.'),
+    )
+
+    def handle_noargs(self, **options):
+        worker = OutboxWorker(threads=options['threads'],
+                              batch_size=options['batch_size'],
+                              max_attempts=options['max_attempts'],
+                              backoff=options['backoff'],
+                              poll_interval=options['poll_interval'])
+        try:
+            worker.run(once=options['once'])
+        except Exception as e:
+            raise CommandError('Sending messages failed: %r (sent %d).' %
+                               (e, worker.sent))
+        self.stdout.write('Sent %d messages, %d failed.\n' %
+                          (worker.sent, worker.failed))
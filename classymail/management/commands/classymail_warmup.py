@@ -0,0 +1,15 @@
+from django.core.management.base import NoArgsCommand
+from classymail.warmup import warmup
+
+
+class Command(NoArgsCommand):
+    help = ("Preloads settings, templates and stylesheets used by all "
+            "e-mail classes.")
+
+    def handle_noargs(self, **options):
+        warmed = warmup()
+        if int(options.get('verbosity', 1)) > 1:
+            for builder_class in warmed:
+                self.stdout.write('%s.%s\n' % (builder_class.__module__,
+                                               builder_class.__name__))
+        self.stdout.write('Warmed up %d e-mail classes.\n' % len(warmed))
@@ -0,0 +1,74 @@
+"""
+classymail.message
+~~~~~~~~~~~~~~~~~~
+
+Message classes used by ClassyMail.
+"""
+import email
+from cStringIO import StringIO
+from email.generator import Generator
+from email.message import Message
+from email.utils import formatdate
+from django.core import mail
+from django.core.mail.message import make_msgid
+
+
+class ParsedMessage(Message):
+    """
+    A parsed MIME message which is serialized without mangling lines starting
+    with "From " (like django's SafeMIME classes).
+    """
+    def as_string(self, unixfrom=False):
+        fp = StringIO()
+        g = Generator(fp, mangle_from_=False)
+        g.flatten(self, unixfrom=unixfrom)
+        return fp.getvalue()
+
+
+class RawMessage(mail.EmailMessage):
+    """
+    An e-mail message which has already been serialized to MIME.
+
+    Raw messages are cheap to pickle, so they can be passed between
+    processes, and they are sent as they are - without rendering anything
+    again. If `refresh_headers` is True then Date and Message-ID headers are
+    generated again every time the message is serialized.
+    """
+    def __init__(self, raw, from_email=None, to=None, cc=None, bcc=None,
+                 subject='', connection=None, encoding=None,
+                 refresh_headers=False):
+        super(RawMessage, self).__init__(
+            subject=subject, from_email=from_email, to=to, cc=cc, bcc=bcc,
+            connection=connection)
+        self.raw = raw
+        self.encoding = encoding
+        self.refresh_headers = refresh_headers
+
+    @classmethod
+    def from_message(cls, message):
+        """
+        Serializes given `EmailMessage` instance.
+        """
+        return cls(message.message().as_string(),
+                   from_email=message.from_email, to=message.to,
+                   cc=message.cc, bcc=message.bcc, subject=message.subject,
+                   encoding=message.encoding)
+
+    def copy(self, **kwargs):
+        """
+        Returns a copy of the message with given attributes changed.
+        """
+        attrs = dict((name, getattr(self, name)) for name in (
+            'raw', 'from_email', 'to', 'cc', 'bcc', 'subject', 'connection',
+            'encoding', 'refresh_headers'))
+        attrs.update(kwargs)
+        return self.__class__(**attrs)
+
+    def message(self):
+        msg = email.message_from_string(self.raw, ParsedMessage)
+        if self.refresh_headers:
+            del msg['Date']
+            msg['Date'] = formatdate()
+            del msg['Message-ID']
+            msg['Message-ID'] = make_msgid()
+        return msg
@@ -5,15 +5,29 @@ classymail.mixins
 A set of mixins for EmailBuilder. Some of them are part of ClassyMail class,
 rest of them can be mixed when needed.
 """
-from contextlib import nested
+import hashlib
+import pickle
+import re
+import time
+import urlparse
 from django.core import mail
-from django.contrib.sites.models import Site
 from django.utils import timezone, translation
-from django.template.loader import render_to_string
 from django.core.exceptions import ImproperlyConfigured
-from .base import EmailBuilder
-from .utils import isolate_language, isolate_timezone, get_css_inline_function
-from .utils import get_context_processors
+from .attachments import get_inline_image
+from .base import EmailBuilder, SendResult
+from .cache import LRUCache
+from .templates import get_template, render_to_string
+from .tracing import traced
+from .utils import override_locale, get_css_inline_function
+from .utils import get_context_processors, get_current_site, get_domain
+from .utils import Placeholder, UrlBuilder, check_placeholders, personalize
+
+
+# rendered templates shared by many messages (see PersonalizedTemplateMixin)
+_skeletons = LRUCache(maxsize=128)
+# results of context processors with 'locale' or 'process' scope
+_processor_results = LRUCache(maxsize=256)
+_img_src_re = re.compile(r'(<img\b[^>]*?\bsrc=)(["\'])(.*?)\2', re.I | re.S)
 
 
 class ContextMixin(EmailBuilder):
@@ -38,13 +52,39 @@ class ContextProcessorMixin(ContextMixin):
     """
     A mixin which collects data from context processors and adds it to the
     template context.
+
+    Results of processors with 'locale' or 'process' scope (see
+    `classymail.utils.context_processor_scope`) are cached.
     """
     def get_context_data(self):
         data = super(ContextProcessorMixin, self).get_context_data()
         for processor in get_context_processors():
-            data.update(processor(builder=self))
+            data.update(self.call_context_processor(processor))
         return data
 
+    def call_context_processor(self, processor):
+        """
+        Returns result of `processor`, using the cache if its scope allows.
+        """
+        scope = getattr(processor, 'classymail_scope', 'build')
+        if scope == 'build':
+            return processor(builder=self)
+
+        key = (processor, scope)
+        if scope == 'locale':
+            key += (translation.get_language(),
+                    timezone.get_current_timezone_name())
+        cached = _processor_results.get(key)
+        now = time.time()
+        if cached is not None and (cached[0] is None or cached[0] > now):
+            return cached[1]
+
+        result = processor(builder=self)
+        timeout = getattr(processor, 'classymail_timeout', None)
+        expires = now + timeout if timeout is not None else None
+        _processor_results.set(key, (expires, result))
+        return result
+
 
 class LocalizationMixin(EmailBuilder):
     """
@@ -54,9 +94,17 @@ class LocalizationMixin(EmailBuilder):
     By default language and timezone are not changed - you have to provide
     `timezone` and/or `language` arguments/attributes or override
     `get_timezone()` or `get_language()` methods.
+
+    When building many messages at once (see `EmailBuilder.send_many()`)
+    builders are grouped by language and timezone, so each of them is
+    activated only once per chunk. `build()` (including overrides in
+    subclasses) is still called for every builder, but it doesn't activate
+    the locale again.
     """
     timezone = None
     language = None
+    # set while the locale of the builder is activated by build_chunk()
+    _locale_active = False
 
     def get_timezone(self):
         """
@@ -71,15 +119,39 @@ class LocalizationMixin(EmailBuilder):
         return self.language
 
     def build(self):
-        tz, lang = self.get_timezone(), self.get_language()
-        with nested(isolate_language(), isolate_timezone()):
-            if tz:
-                timezone.activate(tz)
-            if lang:
-                translation.activate(lang)
-
+        if self._locale_active:
+            return super(LocalizationMixin, self).build()
+        with override_locale(self.get_timezone(), self.get_language()):
             return super(LocalizationMixin, self).build()
 
+    @classmethod
+    def build_chunk(cls, builders, preserve_order=True):
+        groups, keys, results = {}, [], []
+        for index, builder in enumerate(builders):
+            try:
+                key = (builder.get_timezone(), builder.get_language())
+            except Exception as e:
+                results.append((index, SendResult(builder, None, e)))
+                continue
+            if key not in groups:
+                groups[key] = []
+                keys.append(key)
+            groups[key].append((index, builder))
+
+        for key in keys:
+            with override_locale(*key):
+                for index, builder in groups[key]:
+                    builder._locale_active = True
+                    try:
+                        result = SendResult.from_builder(builder)
+                    finally:
+                        builder._locale_active = False
+                    results.append((index, result))
+
+        if preserve_order:
+            results.sort(key=lambda item: item[0])
+        return [item for index, item in results]
+
 
 class HtmlAndTextTemplateMixin(ContextMixin):
     html_template_name = None
@@ -116,7 +188,7 @@ class HtmlAndTextTemplateMixin(ContextMixin):
         css_inline_fn = get_css_inline_function()
         template_name = self.get_html_template_name()
         body = render_to_string(template_name, context)
-        body = css_inline_fn(body)
+        body = traced('inline_css', self, css_inline_fn, body)
         return body
 
     def render_text_template(self, context):
@@ -130,14 +202,167 @@ class HtmlAndTextTemplateMixin(ContextMixin):
 
     def get_message(self):
         # set context on self and attach html alternative
-        self.context = self.get_context_data()
+        self.context = traced('get_context_data', self, self.get_context_data)
         msg = super(HtmlAndTextTemplateMixin, self).get_message()
-        html_body = self.render_html_template(self.context)
+        html_body = traced('render_html_template', self,
+                           self.render_html_template, self.context)
         msg.attach_alternative(html_body, 'text/html')
         return msg
 
     def get_body(self):
-        return self.render_text_template(self.context)
+        return traced('render_text_template', self, self.render_text_template,
+                      self.context)
+
+
+class PersonalizedTemplateMixin(HtmlAndTextTemplateMixin):
+    """
+    Renders templates (and inlines css) only once for many messages and then
+    just substitutes personalized values for every recipient.
+
+    Shared templates are rendered only with context values listed in
+    `shared_context_keys` - other values (including ``builder``) are not
+    available. Values listed in `personalized_context_keys` are replaced
+    with placeholders. Personalized values (and their attributes) can only
+    be output in templates, like ``{{ user.first_name }}`` - using them with
+    filters, tags or in conditions raises `TemplateSyntaxError`.
+
+    Rendered templates are cached by `get_skeleton_key()` - by default the
+    class, template names, active language and timezone and a digest of
+    shared context values (which have to be picklable).
+    """
+    shared_context_keys = ()
+    personalized_context_keys = ()
+
+    def get_skeleton_key(self, shared):
+        """
+        Returns key identifying templates rendered with `shared` context
+        values.
+        """
+        try:
+            data = pickle.dumps(sorted(shared.items()),
+                                pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            raise ImproperlyConfigured(
+                "Shared context values of %s can't be pickled (%s) - "
+                "override get_skeleton_key()" % (self.__class__.__name__, e))
+        return (self.__class__, self.get_html_template_name(),
+                self.get_text_template_name(), translation.get_language(),
+                timezone.get_current_timezone_name(),
+                hashlib.sha1(data).hexdigest())
+
+    def get_shared_context(self, context):
+        """
+        Returns context values listed in `shared_context_keys`.
+        """
+        if 'builder' in self.shared_context_keys:
+            raise ImproperlyConfigured(
+                "'builder' can't be shared between messages (%s)" %
+                self.__class__.__name__)
+        return dict((name, context[name])
+                    for name in self.shared_context_keys if name in context)
+
+    def check_template(self, template_name):
+        """
+        Raises `TemplateSyntaxError` if filters are applied to personalized
+        values in the template.
+        """
+        from django.template import TemplateSyntaxError, Variable
+        from django.template.base import VariableNode
+        template = get_template(template_name)
+        for node in template.nodelist.get_nodes_by_type(VariableNode):
+            expression = node.filter_expression
+            if (expression.filters and isinstance(expression.var, Variable)
+                    and expression.var.lookups and expression.var.lookups[0]
+                    in self.personalized_context_keys):
+                raise TemplateSyntaxError(
+                    "Filters can't be applied to personalized value '%s' "
+                    "in %s" % (expression.var.var, template_name))
+
+    def get_skeleton(self, context):
+        """
+        Returns (html, text) pair of templates rendered with shared context
+        and placeholders instead of personalized values.
+        """
+        shared = self.get_shared_context(context)
+        key = self.get_skeleton_key(shared)
+        skeleton = _skeletons.get(key)
+        if skeleton is None:
+            self.check_template(self.get_html_template_name())
+            self.check_template(self.get_text_template_name())
+            errors = []
+            for name in self.personalized_context_keys:
+                shared[name] = Placeholder(name, errors)
+            parent = super(PersonalizedTemplateMixin, self)
+            skeleton = (parent.render_html_template(shared),
+                        parent.render_text_template(shared))
+            if errors:
+                # some tags silence exceptions raised by placeholders
+                raise errors[0]
+            for content in skeleton:
+                check_placeholders(content)
+            _skeletons.set(key, skeleton)
+        return skeleton
+
+    def render_html_template(self, context):
+        return personalize(self.get_skeleton(context)[0], context)
+
+    def render_text_template(self, context):
+        return personalize(self.get_skeleton(context)[1], context)
+
+
+class InlineImagesMixin(HtmlAndTextTemplateMixin):
+    """
+    Embeds chosen images in the message and references them from html with
+    ``cid:`` urls, so e-mail clients don't have to download them.
+
+    `inline_images` maps image urls used in html templates (absolute urls or
+    just their paths) to image files. Override `get_inline_image_path()` for
+    other rules. Every image is read and encoded once per process.
+    """
+    inline_images = None
+    inline_image_parts = ()
+
+    def get_inline_image_path(self, src):
+        """
+        Returns path of image file which should be embedded instead of `src`
+        or None.
+        """
+        if not self.inline_images:
+            return None
+        return (self.inline_images.get(src) or
+                self.inline_images.get(urlparse.urlparse(src).path))
+
+    def embed_images(self, html):
+        """
+        Replaces sources of embedded images with ``cid:`` urls.
+
+        Returns html and list of MIME parts of embedded images.
+        """
+        parts = []
+
+        def replace(match):
+            path = self.get_inline_image_path(match.group(3))
+            if path is None:
+                return match.group(0)
+            part = get_inline_image(path)
+            if part not in parts:
+                parts.append(part)
+            return '%s%scid:%s%s' % (match.group(1), match.group(2),
+                                     part['Content-ID'][1:-1], match.group(2))
+        return _img_src_re.sub(replace, html), parts
+
+    def render_html_template(self, context):
+        html = super(InlineImagesMixin, self).render_html_template(context)
+        html, self.inline_image_parts = self.embed_images(html)
+        return html
+
+    def get_message(self):
+        msg = super(InlineImagesMixin, self).get_message()
+        if self.inline_image_parts:
+            msg.mixed_subtype = 'related'
+            for part in self.inline_image_parts:
+                msg.attach(part)
+        return msg
 
 
 class SiteMixin(ContextMixin):
@@ -145,6 +370,10 @@ class SiteMixin(ContextMixin):
     Adds current site to the rendering context.
 
     You can override site by using `site` argument/attribute.
+
+    Site and domain are resolved only once per builder and reused by
+    `{% build_absolute_url %}` tags, which build urls using `UrlBuilder`
+    returned by `get_url_builder()`.
     """
     site = None
 
@@ -154,9 +383,25 @@ class SiteMixin(ContextMixin):
         """
         if self.site is not None:
             return self.site
-        if not Site._meta.installed:
-            return None
-        return Site.objects.get_current()
+        if not hasattr(self, '_current_site'):
+            self._current_site = get_current_site()
+        return self._current_site
+
+    def get_domain(self):
+        """
+        Returns domain used to build absolute urls.
+        """
+        if not hasattr(self, '_domain'):
+            self._domain = get_domain(self.get_site())
+        return self._domain
+
+    def get_url_builder(self):
+        """
+        Returns `UrlBuilder` used to build absolute urls for this message.
+        """
+        if not hasattr(self, '_url_builder'):
+            self._url_builder = UrlBuilder(self)
+        return self._url_builder
 
     def get_context_data(self):
         data = super(SiteMixin, self).get_context_data()
@@ -0,0 +1,375 @@
+"""
+classymail.outbox
+~~~~~~~~~~~~~~~~~
+
+Deferred sending of e-mail messages.
+
+`EmailBuilder.send_later()` stores path of the builder class and its keyword
+arguments in an outbox and returns immediately, so requests don't have to
+wait for rendering and SMTP round trips. Already built messages can be
+stored with `Outbox.put_message()`. Messages are sent by
+``manage.py classymail_drain``, which runs `OutboxWorker`.
+
+The outbox is set by CLASSYMAIL_OUTBOX setting (with options passed to its
+constructor in CLASSYMAIL_OUTBOX_OPTIONS):
+
+* ``classymail.outbox.DatabaseOutbox`` (default) - table of
+  `classymail.contrib.outbox.models.OutboxMessage`, requires
+  ``classymail.contrib.outbox`` in INSTALLED_APPS
+* ``classymail.outbox.SQLiteOutbox`` - local SQLite database, requires
+  ``path`` option
+
+Keyword arguments of builders have to be picklable.
+"""
+import base64
+import datetime
+import logging
+import pickle
+import sqlite3
+import threading
+import time
+from functools import partial
+from django.core import mail
+from .base import SendResult, get_builders, send_results
+from .conf import get_config
+from .message import RawMessage
+from .utils import close_db_connections, get_function_by_path
+from .utils import resolved_setting
+
+
+logger = logging.getLogger('classymail.outbox')
+
+
+def dumps(payload):
+    return base64.b64encode(pickle.dumps(payload, pickle.HIGHEST_PROTOCOL))
+
+
+def loads(data):
+    return pickle.loads(base64.b64decode(data))
+
+
+def get_builder_class(path):
+    """
+    Returns EmailBuilder subclass identified by dotted path.
+    """
+    builder_class = get_builders().get(path)
+    if builder_class is None:
+        builder_class = get_function_by_path(path)
+    return builder_class
+
+
+def build_payload(payload):
+    """
+    Returns message stored in the outbox.
+    """
+    kind, value = payload
+    if kind == 'message':
+        return value
+    path, kwargs = value
+    builder_class = get_builder_class(path)
+    builder = builder_class(**kwargs)
+    builder_class.prefetch([builder])
+    return builder.build()
+
+
+class Outbox(object):
+    """
+    Base class for outboxes.
+
+    Claimed messages are hidden from other workers for `lease` seconds - if
+    a worker dies they're sent again after that time.
+    """
+    lease = 300
+
+    def __init__(self, lease=None):
+        if lease is not None:
+            self.lease = lease
+
+    def put_builder(self, builder_class, kwargs, delay=0):
+        """
+        Stores builder class and its keyword arguments. Returns id.
+        """
+        path = '%s.%s' % (builder_class.__module__, builder_class.__name__)
+        return self.put(('builder', (path, kwargs)), delay)
+
+    def put_message(self, message, delay=0):
+        """
+        Stores already built message. Returns id.
+        """
+        return self.put(('message', RawMessage.from_message(message)), delay)
+
+    def put(self, payload, delay=0):
+        """
+        Stores payload which can be sent after `delay` seconds. Returns id.
+        """
+        raise NotImplementedError
+
+    def claim(self, limit):
+        """
+        Returns up to `limit` (id, payload, attempts) tuples of messages ready
+        to be sent, hiding them from other workers.
+        """
+        raise NotImplementedError
+
+    def done(self, id):
+        """
+        Removes sent message.
+        """
+        raise NotImplementedError
+
+    def retry(self, id, delay, error):
+        """
+        Makes message available again after `delay` seconds.
+        """
+        raise NotImplementedError
+
+    def fail(self, id, error):
+        """
+        Marks message as failed - it won't be sent again.
+        """
+        raise NotImplementedError
+
+
+class DatabaseOutbox(Outbox):
+    """
+    Outbox stored in `classymail.contrib.outbox.models.OutboxMessage` table
+    (add ``classymail.contrib.outbox`` to INSTALLED_APPS).
+    """
+    def _now(self, delay=0):
+        from django.utils import timezone
+        return timezone.now() + datetime.timedelta(seconds=delay)
+
+    def put(self, payload, delay=0):
+        from .contrib.outbox.models import OutboxMessage
+        return OutboxMessage.objects.create(
+            payload=dumps(payload), available_at=self._now(delay)).pk
+
+    def claim(self, limit):
+        from .contrib.outbox.models import OutboxMessage
+        now = self._now()
+        lease_until = self._now(self.lease)
+        rows = OutboxMessage.objects.filter(
+            failed=False, available_at__lte=now)[:limit]
+        claimed = []
+        for row in rows:
+            # the row could be claimed by another worker in the meantime
+            updated = OutboxMessage.objects.filter(
+                pk=row.pk, available_at=row.available_at).update(
+                available_at=lease_until)
+            if updated:
+                claimed.append((row.pk, loads(row.payload), row.attempts))
+        return claimed
+
+    def done(self, id):
+        from .contrib.outbox.models import OutboxMessage
+        OutboxMessage.objects.filter(pk=id).delete()
+
+    def retry(self, id, delay, error):
+        from django.db.models import F
+        from .contrib.outbox.models import OutboxMessage
+        OutboxMessage.objects.filter(pk=id).update(
+            attempts=F('attempts') + 1, available_at=self._now(delay),
+            last_error=repr(error))
+
+    def fail(self, id, error):
+        from django.db.models import F
+        from .contrib.outbox.models import OutboxMessage
+        OutboxMessage.objects.filter(pk=id).update(
+            attempts=F('attempts') + 1, failed=True, last_error=repr(error))
+
+
+class SQLiteOutbox(Outbox):
+    """
+    Outbox stored in a local SQLite database at `path`.
+    """
+    def __init__(self, path, lease=None):
+        super(SQLiteOutbox, self).__init__(lease)
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS classymail_outbox ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT, '
+                'attempts INTEGER DEFAULT 0, available_at REAL, '
+                'failed INTEGER DEFAULT 0, last_error TEXT)')
+            self._local.connection = connection
+        return connection
+
+    def put(self, payload, delay=0):
+        cursor = self.connection.execute(
+            'INSERT INTO classymail_outbox (payload, available_at) '
+            'VALUES (?, ?)', (dumps(payload), time.time() + delay))
+        return cursor.lastrowid
+
+    def claim(self, limit):
+        connection = self.connection
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(
+                'SELECT id, payload, attempts FROM classymail_outbox '
+                'WHERE failed = 0 AND available_at <= ? ORDER BY id LIMIT ?',
+                (now, limit)).fetchall()
+            connection.executemany(
+                'UPDATE classymail_outbox SET available_at = ? WHERE id = ?',
+                [(now + self.lease, row[0]) for row in rows])
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        return [(id, loads(payload), attempts)
+                for id, payload, attempts in rows]
+
+    def done(self, id):
+        self.connection.execute('DELETE FROM classymail_outbox WHERE id = ?',
+                                (id,))
+
+    def retry(self, id, delay, error):
+        self.connection.execute(
+            'UPDATE classymail_outbox SET attempts = attempts + 1, '
+            'available_at = ?, last_error = ? WHERE id = ?',
+            (time.time() + delay, repr(error), id))
+
+    def fail(self, id, error):
+        self.connection.execute(
+            'UPDATE classymail_outbox SET attempts = attempts + 1, '
+            'failed = 1, last_error = ? WHERE id = ?', (repr(error), id))
+
+
+@resolved_setting('CLASSYMAIL_OUTBOX')
+def get_outbox():
+    """
+    Returns outbox set by CLASSYMAIL_OUTBOX setting.
+    """
+    config = get_config()
+    outbox_class = get_function_by_path(
+        config.OUTBOX or 'classymail.outbox.DatabaseOutbox')
+    return outbox_class(**(config.OUTBOX_OPTIONS or {}))
+
+
+class OutboxWorker(object):
+    """
+    Sends messages from `outbox` using `threads` threads.
+
+    Every thread opens its own connection and keeps it open between batches
+    of `batch_size` messages (it's opened again after a failure). Failed
+    messages are retried after ``backoff * 2 ** attempts`` seconds, until
+    they fail `max_attempts` times.
+    """
+    def __init__(self, outbox=None, threads=4, batch_size=100, max_attempts=5,
+                 backoff=60, poll_interval=5, connection_factory=None):
+        self.outbox = outbox or get_outbox()
+        self.threads = threads
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.connection_factory = connection_factory or mail.get_connection
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.errors = []
+
+    def stop(self):
+        """
+        Stops all threads after their current batches.
+        """
+        self.stopped.set()
+
+    def run(self, once=False):
+        """
+        Sends messages until `stop()` is called (or until the outbox is empty
+        if `once` is True). Returns number of sent messages.
+
+        Errors (e.g. a database which is down) are logged and the batch is
+        retried after `poll_interval` seconds. If `once` is True the first
+        error stops all threads and is raised.
+        """
+        threads = [threading.Thread(target=self._run, args=(once,))
+                   for i in range(self.threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt:
+            self.stop()
+            raise
+        if self.errors:
+            raise self.errors[0]
+        return self.sent
+
+    def _run(self, once):
+        connection = self.connection_factory()
+        try:
+            while not self.stopped.is_set():
+                try:
+                    # does nothing if the connection is already open
+                    connection.open()
+                    claimed = self.drain_batch(connection)
+                except Exception as e:
+                    if once:
+                        raise
+                    logger.exception('Draining outbox failed: %r', e)
+                    close_db_connections()
+                    self.stopped.wait(self.poll_interval)
+                    continue
+                if not claimed:
+                    if once:
+                        break
+                    self.stopped.wait(self.poll_interval)
+        except Exception as e:
+            logger.exception('Draining outbox failed: %r', e)
+            with self._lock:
+                self.errors.append(e)
+            self.stop()
+        finally:
+            connection.close()
+            close_db_connections()
+
+    def drain_batch(self, connection):
+        """
+        Claims and sends a single batch of messages using opened
+        `connection`. Returns number of claimed messages.
+
+        Messages are sent one by one, so only those which failed are retried.
+        The connection is closed after a failure (the next batch opens it
+        again), because it may be broken.
+        """
+        claimed = self.outbox.claim(self.batch_size)
+        if not claimed:
+            return 0
+
+        results = send_results(
+            [SendResult.from_builder(None, partial(build_payload, payload))
+             for id, payload, attempts in claimed], connection)
+
+        sent = failed = 0
+        for (id, payload, attempts), result in zip(claimed, results):
+            if result.sent:
+                self.outbox.done(id)
+                sent += 1
+                continue
+            logger.warning('Sending message %s failed: %r', id, result.error)
+            if attempts + 1 >= self.max_attempts:
+                self.outbox.fail(id, result.error)
+                failed += 1
+            else:
+                self.outbox.retry(id, self.backoff * 2 ** attempts,
+                                  result.error)
+        if any(result.message is not None and not result.sent
+               for result in results):
+            connection.close()
+        with self._lock:
+            self.sent += sent
+            self.failed += failed
+        return len(claimed)
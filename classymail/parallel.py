@@ -0,0 +1,189 @@
+"""
+classymail.parallel
+~~~~~~~~~~~~~~~~~~~
+
+Building and sending messages in pools of worker processes and threads.
+
+Rendering templates and inlining css is CPU-bound, so large campaigns can be
+built on all available cores. Workers build messages and send them back to
+the parent process serialized as `RawMessage` instances, which are then sent
+using a single connection::
+
+    from classymail.parallel import send_in_processes
+
+    results = send_in_processes(WelcomeMail, ({'user': user} for user in users))
+
+Builder classes and keyword arguments have to be picklable.
+
+`AsyncSender` builds and sends messages in a bounded pool of threads, so
+views don't have to wait for rendering and SMTP round trips::
+
+    sender = AsyncSender(max_workers=4)
+    sender.send(WelcomeMail, user=user)
+"""
+import multiprocessing
+from functools import partial
+from multiprocessing.pool import ThreadPool
+import django
+from django.core import mail
+from .base import SendResult, chunks, send_results
+from .message import RawMessage
+from .utils import close_db_connections
+
+
+def _init_worker():
+    if hasattr(django, 'setup'):  # Django >= 1.7
+        django.setup()
+
+
+def _build(builder):
+    try:
+        return RawMessage.from_message(builder.build()), None
+    except Exception as e:
+        return None, e
+
+
+def _build_chunk(args):
+    builder_class, kwargs_list = args
+    builders, results = [], []
+    for kwargs in kwargs_list:
+        try:
+            builders.append(builder_class(**kwargs))
+            results.append(None)
+        except Exception as e:
+            results.append((None, e))
+    try:
+        builder_class.prefetch(builders)
+    except Exception as e:
+        return [result or (None, e) for result in results]
+    built = iter(builders)
+    return [result or _build(next(built)) for result in results]
+
+
+def build_in_processes(builder_class, kwargs_list, processes=None,
+                       chunksize=10):
+    """
+    Builds a message for every dictionary of keyword arguments in
+    `kwargs_list` using a pool of `processes` workers (defaults to number of
+    cores). Workers receive chunks of `chunksize` messages (see
+    `EmailBuilder.prefetch()`).
+
+    Yields (message, error) pairs in the same order as `kwargs_list`, where
+    message is a `RawMessage` instance or None if an exception was raised.
+    """
+    # database connections can't be shared with forked workers and closing
+    # them in a worker would end the session of the parent process, so they
+    # are closed before forking (the parent connects again when needed)
+    close_db_connections()
+    pool = multiprocessing.Pool(processes, initializer=_init_worker)
+    try:
+        tasks = ((builder_class, chunk)
+                 for chunk in chunks(kwargs_list, chunksize))
+        for results in pool.imap(_build_chunk, tasks):
+            for result in results:
+                yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def send_in_processes(builder_class, kwargs_list, processes=None,
+                      connection=None, chunk_size=100):
+    """
+    Builds messages using `build_in_processes()` and sends them in chunks of
+    `chunk_size` messages using a single connection.
+
+    Returns list of `SendResult` instances (without builders, which live in
+    worker processes) in the same order as `kwargs_list`.
+    """
+    if connection is None:
+        connection = mail.get_connection()
+
+    built = build_in_processes(builder_class, kwargs_list, processes,
+                               chunksize=max(1, chunk_size // 10))
+    results = []
+    opened = connection.open()
+    try:
+        for chunk in chunks(built, chunk_size):
+            results.extend(send_results(
+                [SendResult(None, message, error) for message, error in chunk],
+                connection))
+    finally:
+        if opened:
+            connection.close()
+    return results
+
+
+class AsyncSender(object):
+    """
+    Builds and sends messages in a pool of `max_workers` threads.
+
+    All methods return immediately with `multiprocessing.pool.AsyncResult`
+    instances; their results (also passed to optional `callback`) are
+    `SendResult` instances, so exceptions never propagate to the caller.
+    """
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self._pool = ThreadPool(max_workers)
+
+    def _submit(self, fn, args, callback):
+        return self._pool.apply_async(self._run, (fn,) + args,
+                                      callback=callback)
+
+    @staticmethod
+    def _run(fn, *args):
+        try:
+            return fn(*args)
+        finally:
+            # threads would leak database connections otherwise
+            close_db_connections()
+
+    @staticmethod
+    def _build(builder_class, kwargs):
+        try:
+            builder = builder_class(**kwargs)
+            builder_class.prefetch([builder])
+        except Exception as e:
+            return SendResult(None, None, e)
+        return SendResult.from_builder(builder)
+
+    @classmethod
+    def _send(cls, builder_class, kwargs):
+        result = cls._build(builder_class, kwargs)
+        if result.sent:
+            connection = result.message.connection or mail.get_connection()
+            result = send_results([result], connection)[0]
+        return result
+
+    def build(self, builder_class, callback=None, **kwargs):
+        """
+        Builds a message using `builder_class` and keyword arguments.
+        """
+        return self._submit(self._build, (builder_class, kwargs), callback)
+
+    def send(self, builder_class, callback=None, **kwargs):
+        """
+        Builds and sends a message using `builder_class` and keyword
+        arguments.
+        """
+        return self._submit(self._send, (builder_class, kwargs), callback)
+
+    def send_many(self, builder_class, kwargs_list, callback=None, **options):
+        """
+        Sends messages using `builder_class.send_many()`. Result is a list of
+        `SendResult` instances.
+        """
+        send_many = partial(builder_class.send_many, **options)
+        return self._submit(send_many, (list(kwargs_list),), callback)
+
+    def close(self, wait=True):
+        """
+        Stops accepting new messages and (optionally) waits until all
+        submitted messages are sent.
+        """
+        self._pool.close()
+        if wait:
+            self._pool.join()
@@ -0,0 +1,124 @@
+"""
+classymail.templates
+~~~~~~~~~~~~~~~~~~~~
+
+Cache of compiled templates used by `HtmlAndTextTemplateMixin`.
+
+Without django's cached template loader every `render_to_string()` call
+searches template directories and compiles the template again. ClassyMail
+keeps compiled templates keyed by template name and active language, and
+compiles them again only when modification time of template source changes.
+
+The cache can be warmed up at startup with `warm()` and emptied with
+`clear()`. Note that only the modification time of the template itself is
+checked - not of templates it extends or includes.
+"""
+import os
+from django.conf import settings
+from django.utils import translation
+from .cache import LRUCache
+from .utils import get_setting_changed_signal
+
+
+#: Maximum number of compiled templates kept in memory.
+TEMPLATE_CACHE_SIZE = 256
+
+_templates = LRUCache(maxsize=TEMPLATE_CACHE_SIZE)
+_loaders = []
+
+
+def clear(**kwargs):
+    """
+    Removes all compiled templates from the cache.
+    """
+    _templates.clear()
+    del _loaders[:]
+
+
+def _setting_changed(sender, setting, **kwargs):
+    if setting.startswith('TEMPLATE'):
+        clear()
+
+
+def _flatten(loaders):
+    for template_loader in loaders:
+        # cached loader wraps other loaders
+        for inner in _flatten(getattr(template_loader, 'loaders', ())):
+            yield inner
+        yield template_loader
+
+
+def get_loaders():
+    """
+    Returns template loaders (including loaders wrapped by other loaders).
+    """
+    if not _loaders:
+        from django.template import loader
+        get_setting_changed_signal().connect(
+            _setting_changed, dispatch_uid='classymail.templates')
+        # other threads may be iterating over loaders, so the list is
+        # replaced at once
+        _loaders[:] = list(_flatten(
+            filter(None, [loader.find_template_loader(path)
+                          for path in settings.TEMPLATE_LOADERS])))
+    return _loaders
+
+
+def get_template_mtime(template_name):
+    """
+    Returns modification time of template source or None if it can't be
+    determined.
+    """
+    for template_loader in get_loaders():
+        get_sources = getattr(template_loader, 'get_template_sources', None)
+        if get_sources is None:
+            continue
+        for path in get_sources(template_name):
+            try:
+                return os.path.getmtime(path)
+            except OSError:
+                continue
+    return None
+
+
+def get_template(template_name):
+    """
+    Returns compiled template, compiling it only if it's not cached yet or
+    if its source has changed.
+
+    Like django's `render_to_string()` it accepts a list or tuple of names -
+    the first existing template is used.
+    """
+    from django.template import loader
+    if isinstance(template_name, (list, tuple)):
+        template_name = tuple(template_name)
+        mtime = tuple(get_template_mtime(name) for name in template_name)
+        get = loader.select_template
+    else:
+        mtime = get_template_mtime(template_name)
+        get = loader.get_template
+
+    key = (template_name, translation.get_language())
+    cached = _templates.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    template = get(template_name)
+    _templates.set(key, (mtime, template))
+    return template
+
+
+def warm(template_names):
+    """
+    Compiles given templates and stores them in the cache.
+    """
+    for template_name in template_names:
+        get_template(template_name)
+
+
+def render_to_string(template_name, context):
+    """
+    Renders template with given context using the cache.
+    """
+    from django.template import Context
+    return get_template(template_name).render(Context(context))
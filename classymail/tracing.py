@@ -0,0 +1,170 @@
+"""
+classymail.tracing
+~~~~~~~~~~~~~~~~~~
+
+Hooks for measuring how long each stage of building and sending messages
+takes.
+
+A tracer is a callable which receives stage name, builder (or None), duration
+of the stage in seconds, size of its result in bytes (of rendered content or
+serialized message, None if the stage failed) and the exception raised by the
+stage (or None). Stages reported by ClassyMail are:
+
+* get_context_data
+* render_text_template
+* render_html_template (including css inlining)
+* inline_css
+* get_message
+* send
+
+Tracing is disabled by default and costs almost nothing. To collect
+statistics in memory use `StatsTracer`::
+
+    from classymail import tracing
+
+    stats = tracing.StatsTracer()
+    tracing.set_tracer(stats)
+    ...
+    print(stats.summary())
+"""
+import threading
+import time
+from django.core import mail
+
+
+_tracer = None
+
+
+def set_tracer(tracer):
+    """
+    Sets active tracer. Use None to disable tracing.
+    """
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer():
+    """
+    Returns active tracer or None.
+    """
+    return _tracer
+
+
+def get_size(result):
+    """
+    Returns size of result of a stage in bytes - length of encoded text or
+    of serialized message - or None.
+    """
+    if isinstance(result, unicode):
+        return len(result.encode('utf-8'))
+    if isinstance(result, str):
+        return len(result)
+    if isinstance(result, mail.EmailMessage):
+        return len(result.message().as_string())
+    return None
+
+
+def traced(stage, builder, fn, *args, **kwargs):
+    """
+    Calls `fn` with given arguments and reports duration of the call to
+    the active tracer, also when `fn` raises an exception.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return fn(*args, **kwargs)
+
+    start = time.time()
+    result = error = None
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        duration = time.time() - start
+        tracer(stage, builder, duration,
+               get_size(result) if error is None else None, error)
+    return result
+
+
+class StageStats(object):
+    """
+    Statistics collected for a single stage.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.histogram = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.total_size = 0
+        self.errors = 0
+
+    def add(self, duration, size, error=None):
+        self.count += 1
+        if error is not None:
+            self.errors += 1
+        self.total += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+        if size is not None:
+            self.total_size += size
+        for i, bound in enumerate(self.buckets):
+            if duration <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'total_size': self.total_size,
+            'errors': self.errors,
+            'histogram': list(zip(self.buckets + (None,), self.histogram)),
+        }
+
+
+class StatsTracer(object):
+    """
+    Tracer which keeps duration histograms, sizes and numbers of errors of
+    every stage in memory.
+
+    `buckets` are upper bounds (in seconds) of histogram buckets. The last,
+    implicit bucket collects all longer durations.
+    """
+    buckets = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+    def __init__(self, buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, stage, builder, duration, size, error=None):
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = StageStats(self.buckets)
+            self.stages[stage].add(duration, size, error)
+
+    def summary(self):
+        """
+        Returns dictionary with statistics for every stage.
+        """
+        with self._lock:
+            return dict((stage, stats.as_dict())
+                        for stage, stats in self.stages.items())
+
+    def reset(self):
+        """
+        Removes collected statistics.
+        """
+        with self._lock:
+            self.stages = {}
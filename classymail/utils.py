@@ -1,16 +1,89 @@
+import hashlib
+import re
+from contextlib import contextmanager, nested
+from functools import wraps
 from django.conf import settings
-from django.contrib.sites.models import Site
 from django.core.exceptions import ImproperlyConfigured
 from django.utils import timezone, translation
+from django.utils.encoding import force_unicode
+from django.utils.html import conditional_escape
 from django.utils.importlib import import_module
+from .conf import clear_config, get_config, get_setting_changed_signal
+
+
+# functions resolved from dotted paths and values resolved from settings
+_functions = {}
+_resolved = {}
+# current sites by SITE_ID
+_sites = {}
+
+CONTEXT_PROCESSOR_SCOPES = ('build', 'locale', 'process')
+
+
+def clear_site_cache(**kwargs):
+    """
+    Clears cached current sites.
+
+    Called automatically when SITE_ID setting is changed or when a site is
+    saved or deleted.
+    """
+    _sites.clear()
+
+
+def clear_caches():
+    """
+    Clears resolved functions, settings and sites.
+
+    Called automatically when any CLASSYMAIL_* setting is changed using
+    `override_settings`.
+    """
+    clear_config()
+    _functions.clear()
+    _resolved.clear()
+    clear_site_cache()
+
+
+def _setting_changed(sender, setting, **kwargs):
+    if setting.startswith('CLASSYMAIL_'):
+        clear_caches()
+    elif setting == 'SITE_ID':
+        clear_site_cache()
+
+
+def _connect_setting_changed():
+    get_setting_changed_signal().connect(
+        _setting_changed, dispatch_uid='classymail.utils')
+
+
+def resolved_setting(setting):
+    """
+    Decorator which caches the result of a function resolving `setting`
+    (like a dotted path to a function) until the setting is changed.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper():
+            try:
+                return _resolved[setting]
+            except KeyError:
+                _connect_setting_changed()
+                value = _resolved[setting] = fn()
+                return value
+        return wrapper
+    return decorator
 
 
 class isolate_timezone(object):
     """
     This context manager makes sure that any change to an active timezone
     will be reverted.
+
+    Active timezone is local to the current thread, so it's safe to use it
+    in many threads at once.
     """
     def __enter__(self):
+        # like django.utils.timezone.override - get_current_timezone() would
+        # return the default timezone if none is active
         self.timezone = getattr(timezone._active, 'value', None)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -22,8 +95,11 @@ class isolate_timezone(object):
 
 class isolate_language(object):
     """
-    This context manager makes sure that any change to an active timezone
+    This context manager makes sure that any change to an active language
     will be reverted.
+
+    Active language is local to the current thread, so it's safe to use it
+    in many threads at once.
     """
     def __enter__(self):
         self.language = translation.get_language()
@@ -32,42 +108,135 @@ class isolate_language(object):
         translation.activate(self.language)
 
 
+@contextmanager
+def override_locale(tz=None, language=None):
+    """
+    Activates given timezone and language (if not None) and restores
+    previously active ones on exit.
+    """
+    with nested(isolate_language(), isolate_timezone()):
+        if tz:
+            timezone.activate(tz)
+        if language:
+            translation.activate(language)
+        yield
+
+
+def close_db_connections():
+    """
+    Closes database connections of the current thread (django opens them
+    again when needed).
+    """
+    from django.db import connections
+    for connection in connections.all():
+        connection.close()
+
+
 def get_function_by_path(fn_path):
     """
     Returns function identified by dotted path.
 
-    Path is something like mypackage.mymodule.myfunction.
+    Path is something like mypackage.mymodule.myfunction. Resolved functions
+    are cached.
     """
-    mod_path, fn_name = fn_path.rsplit('.', 1)
-    mod = import_module(mod_path)
-    return getattr(mod, fn_name)
+    try:
+        return _functions[fn_path]
+    except KeyError:
+        _connect_setting_changed()
+        mod_path, fn_name = fn_path.rsplit('.', 1)
+        mod = import_module(mod_path)
+        fn = _functions[fn_path] = getattr(mod, fn_name)
+        return fn
 
 
 def _css_inline_noop(arg):
     return arg
 
 
+def get_cache(alias):
+    """
+    Returns django cache configured in CACHES setting under `alias`.
+    """
+    try:
+        from django.core.cache import caches
+    except ImportError:  # Django < 1.7
+        from django.core.cache import get_cache
+        return get_cache(alias)
+    return caches[alias]
+
+
+def _get_css_inliner():
+    config = get_config()
+    if config.CSS_INLINER:
+        return get_function_by_path(config.CSS_INLINER)(
+            **(config.CSS_INLINER_OPTIONS or {}))
+
+    fn_path = config.CSS_INLINE_FUNCTION
+    if not fn_path:
+        return _css_inline_noop
+    return get_function_by_path(fn_path)
+
+
+@resolved_setting('CLASSYMAIL_CSS_INLINE_FUNCTION')
 def get_css_inline_function():
     """
     Returns function used for css inlining.
 
-    If CLASSYMAIL_CSS_INLINE_FUNCTION is set to None then no-op function is
+    If CLASSYMAIL_CSS_INLINER is set then an instance of that inliner class
+    (created with CLASSYMAIL_CSS_INLINER_OPTIONS) is returned. Otherwise if
+    CLASSYMAIL_CSS_INLINE_FUNCTION is set to None then no-op function is
     returned.
+
+    If CLASSYMAIL_CSS_INLINE_CACHE is set to an alias of a django cache then
+    the function is wrapped with `classymail.inline.CachedInliner`, so the
+    same html is inlined only once by all processes sharing that cache.
     """
-    fn_path = getattr(settings, 'CLASSYMAIL_CSS_INLINE_FUNCTION',
-        'premailer.transform')
-    if not fn_path:
-        return _css_inline_noop
-    return get_function_by_path(fn_path)
+    config = get_config()
+    inline_fn = _get_css_inliner()
+    if not config.CSS_INLINE_CACHE or inline_fn is _css_inline_noop:
+        return inline_fn
+
+    from .inline import CachedInliner
+    # results of different inliners (or options) must not be mixed
+    inliner_config = repr([config.CSS_INLINER, config.CSS_INLINER_OPTIONS,
+                           config.CSS_INLINE_FUNCTION])
+    digest = hashlib.sha1(inliner_config.encode('utf-8')).hexdigest()
+    return CachedInliner(
+        inline_fn, get_cache(config.CSS_INLINE_CACHE),
+        key_prefix='classymail:inline:%s' % digest[:8],
+        timeout=config.CSS_INLINE_CACHE_TIMEOUT)
+
+
+def context_processor_scope(scope, timeout=None):
+    """
+    Decorator declaring for how long results of a context processor can be
+    reused by `ContextProcessorMixin`:
+
+    * 'build' - processor is called for every message (default)
+    * 'locale' - results are reused for the same language and timezone
+    * 'process' - results are reused by all messages built by the process
+
+    Results of 'locale' and 'process' processors are cached for `timeout`
+    seconds (forever if None) and they can't depend on the builder.
+    """
+    if scope not in CONTEXT_PROCESSOR_SCOPES:
+        raise ValueError("Unknown context processor scope: %r" % scope)
+
+    def decorator(fn):
+        fn.classymail_scope = scope
+        fn.classymail_timeout = timeout
+        return fn
+    return decorator
 
 
+@resolved_setting('CLASSYMAIL_CONTEXT_PROCESSORS')
 def get_context_processors():
     """
     Returns list of classymail context processors.
     """
     return [
         get_function_by_path(path) for path in
-        (getattr(settings, 'CLASSYMAIL_CONTEXT_PROCESSORS', None) or ())
+        (get_config().CONTEXT_PROCESSORS or ())
     ]
 
 
@@ -76,26 +245,53 @@ def get_secure(secure):
     Returns "secure" param based on CLASSYMAIL_ALLOW_SECURE and
     CLASSYMAIL_ALWAYS_SECURE settings.
     """
-    ALLOW_SECURE = getattr(settings, 'CLASSYMAIL_ALLOW_SECURE', None)
-    ALWAYS_SECURE = getattr(settings, 'CLASSYMAIL_ALWAYS_SECURE', None)
+    config = get_config()
 
-    if ALWAYS_SECURE:
+    if config.ALWAYS_SECURE:
         return True
 
-    if ALLOW_SECURE or ALLOW_SECURE is None:
+    if config.ALLOW_SECURE or config.ALLOW_SECURE is None:
         return secure
 
     return False
 
 
+def get_current_site():
+    """
+    Returns site based on SITE_ID setting or None if site framework is not
+    installed.
+
+    Sites are cached by SITE_ID until `clear_site_cache()` is called.
+    """
+    site_id = getattr(settings, 'SITE_ID', None)
+    try:
+        return _sites[site_id]
+    except KeyError:
+        pass
+
+    from django.contrib.sites.models import Site
+    from django.db.models import signals
+    _connect_setting_changed()
+    signals.pre_save.connect(clear_site_cache, sender=Site,
+                             dispatch_uid='classymail.utils')
+    signals.pre_delete.connect(clear_site_cache, sender=Site,
+                               dispatch_uid='classymail.utils')
+
+    site = None
+    if Site._meta.installed:
+        site = Site.objects.get_current()
+    _sites[site_id] = site
+    return site
+
+
 def get_site(site=None):
     """
     Returns site based on site param and SITE_ID setting.
 
     Returns None if site framework is not installed.
     """
-    if site is None and Site._meta.installed:
-        site = Site.objects.get_current()
+    if site is None:
+        site = get_current_site()
     return site
 
 
@@ -106,8 +302,9 @@ def get_domain(site=None):
     """
     site = get_site(site)
 
-    domain = getattr(settings, 'CLASSYMAIL_DOMAIN', None)
-    if site and not getattr(settings, 'CLASSYMAIL_OVERRIDE_DOMAIN', None):
+    config = get_config()
+    domain = config.DOMAIN
+    if site and not config.OVERRIDE_DOMAIN:
         domain = site.domain
 
     if not domain:
@@ -129,28 +326,229 @@ def get_path(path=None, object=None):
 
 
 def default_url_function(site=None, object=None, path=None, secure=False,
-                          **kwargs):
+                          builder=None, **kwargs):
     """
     Default url generator.
+
+    Reuses domain already resolved by the builder (see `SiteMixin`) if
+    possible.
     """
-    domain = get_domain(site)
+    if hasattr(builder, 'get_domain') and \
+            (site is None or site is builder.get_site()):
+        domain = builder.get_domain()
+    else:
+        domain = get_domain(site)
     protocol = 'https' if get_secure(secure) else 'http'
     path = get_path(path, object)
 
     return "%s://%s%s" % (protocol, domain, path)
 
 
+@resolved_setting('CLASSYMAIL_URL_FUNCTION')
+def get_url_function():
+    """
+    Returns function set by CLASSYMAIL_URL_FUNCTION setting or None.
+    """
+    fn_path = get_config().URL_FUNCTION
+    if fn_path:
+        return get_function_by_path(fn_path)
+    return None
+
+
 def build_absolute_url(object=None, path=None, site=None,
                  secure=False, context=None, builder=None, **kwargs):
     """
     Generates urls for {% build_absolute_url %} tag using builtin function or function
     set by CLASSYMAIL_URL_FUNCTION setting.
+
+    Uses `UrlBuilder` of the builder (see `SiteMixin.get_url_builder()`) if
+    there is one.
     """
-    fn_path = getattr(settings, 'CLASSYMAIL_URL_FUNCTION', None)
-    if fn_path:
-        fn = get_function_by_path(fn_path)
-    else:
-        fn = default_url_function
+    get_url_builder = getattr(builder, 'get_url_builder', None)
+    if get_url_builder is not None:
+        return get_url_builder().build(object=object, path=path, site=site,
+                                       secure=secure, context=context,
+                                       **kwargs)
+
+    fn = get_url_function() or default_url_function
 
     return fn(builder=builder, object=object, path=path, site=site,
               secure=secure, context=context, **kwargs)
+
+
+class UrlBuilder(object):
+    """
+    Builds absolute urls for a single message.
+
+    Without CLASSYMAIL_URL_FUNCTION the ``scheme://domain`` prefix is computed
+    once for every site and `get_absolute_url()` is called once for every
+    object. Custom url functions can resolve many urls at once (see
+    `build_many()`).
+    """
+    def __init__(self, builder=None):
+        self.builder = builder
+        self.url_function = get_url_function()
+        # values are stored with their site/object, so ids are not reused
+        self._prefixes = {}
+        self._paths = {}
+
+    def get_prefix(self, site=None, secure=False):
+        """
+        Returns ``scheme://domain`` part of urls.
+        """
+        key = (id(site), secure)
+        try:
+            return self._prefixes[key][1]
+        except KeyError:
+            pass
+
+        builder = self.builder
+        if hasattr(builder, 'get_domain') and \
+                (site is None or site is builder.get_site()):
+            domain = builder.get_domain()
+        else:
+            domain = get_domain(site)
+        protocol = 'https' if get_secure(secure) else 'http'
+        prefix = '%s://%s' % (protocol, domain)
+        self._prefixes[key] = (site, prefix)
+        return prefix
+
+    def get_path(self, path=None, object=None):
+        """
+        Returns path, calling `get_absolute_url()` of `object` only once.
+        """
+        if path or object is None:
+            return path
+        try:
+            return self._paths[id(object)][1]
+        except KeyError:
+            path = get_path(object=object)
+            self._paths[id(object)] = (object, path)
+            return path
+
+    def build(self, object=None, path=None, site=None, secure=False,
+              **kwargs):
+        """
+        Returns absolute url for `object` or `path`.
+        """
+        if self.url_function is not None:
+            return self.url_function(builder=self.builder, object=object,
+                                     path=path, site=site, secure=secure,
+                                     **kwargs)
+        return '%s%s' % (self.get_prefix(site, secure),
+                         self.get_path(path, object))
+
+    def build_many(self, items, site=None, secure=False, **kwargs):
+        """
+        Returns list of absolute urls for `items` - objects or paths.
+
+        If url function set by CLASSYMAIL_URL_FUNCTION has `build_many`
+        attribute it's called once with all items (and the same keyword
+        arguments as the function itself).
+        """
+        build_many = getattr(self.url_function, 'build_many', None)
+        if build_many is not None:
+            return build_many(items, builder=self.builder, site=site,
+                              secure=secure, **kwargs)
+        return [self.build(path=item, site=site, secure=secure, **kwargs)
+                if isinstance(item, basestring) else
+                self.build(object=item, site=site, secure=secure, **kwargs)
+                for item in items]
+
+
+# markers must survive css inlining, which escapes some characters in urls
+_placeholder_re = re.compile(r'~~classymail:([\w.]+)~~')
+_marker_re = re.compile(r'~~classymail', re.I)
+
+
+class Placeholder(object):
+    """
+    Stands for a personalized context value while rendering shared parts of
+    an e-mail (see `PersonalizedTemplateMixin`).
+
+    Looking up attributes or items returns nested placeholders and rendering
+    outputs a marker which is later replaced using `personalize()`. Any other
+    use (conditions, comparisons, loops, calls from filters and tags) can't be
+    personalized later, so it raises `TemplateSyntaxError`. Errors are also
+    appended to `errors` list shared by nested placeholders, because some
+    template tags silence exceptions.
+    """
+    do_not_call_in_templates = True
+
+    def __init__(self, path, errors=None):
+        self._path = path
+        self._errors = [] if errors is None else errors
+
+    def _misuse(self, usage):
+        from django.template import TemplateSyntaxError
+        error = TemplateSyntaxError(
+            "Personalized value '%s' was %s - personalized values can only "
+            "be output in templates, without filters" % (self._path, usage))
+        self._errors.append(error)
+        raise error
+
+    def __getitem__(self, key):
+        return Placeholder('%s.%s' % (self._path, key), self._errors)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __unicode__(self):
+        return u'~~classymail:%s~~' % self._path
+
+    def __str__(self):
+        return '~~classymail:%s~~' % self._path
+
+    def __nonzero__(self):
+        self._misuse('used as a condition')
+
+    def __eq__(self, other):
+        self._misuse('compared')
+
+    __ne__ = __lt__ = __le__ = __gt__ = __ge__ = __eq__
+
+    def __len__(self):
+        self._misuse('used as a sequence')
+
+    __iter__ = __contains__ = __len__
+
+    def __int__(self):
+        self._misuse('used as a number')
+
+    __float__ = __long__ = __int__
+
+    def __call__(self, *args, **kwargs):
+        self._misuse('called')
+
+    __hash__ = object.__hash__
+
+
+def check_placeholders(content):
+    """
+    Raises `TemplateSyntaxError` if markers of placeholders in rendered
+    content were changed (for example by filters in included templates).
+    """
+    if len(_marker_re.findall(content)) != \
+            len(_placeholder_re.findall(content)):
+        from django.template import TemplateSyntaxError
+        raise TemplateSyntaxError(
+            "Personalized values were changed by filters or tags - they can "
+            "only be output in templates, without filters")
+
+
+def personalize(content, context):
+    """
+    Replaces placeholder markers in rendered content with escaped values
+    from the context.
+    """
+    from django.template import Variable, VariableDoesNotExist
+
+    def replace(match):
+        try:
+            value = Variable(match.group(1)).resolve(context)
+        except VariableDoesNotExist:
+            value = settings.TEMPLATE_STRING_IF_INVALID
+        return conditional_escape(force_unicode(value))
+    return _placeholder_re.sub(replace, content)
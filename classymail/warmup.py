@@ -0,0 +1,96 @@
+"""
+classymail.warmup
+~~~~~~~~~~~~~~~~~
+
+Preloading everything used by e-mail classes, so the first message sent by
+a freshly started worker is not slower than the following ones.
+
+Call `warmup()` at startup (for example in your wsgi.py) or run
+``manage.py classymail_warmup``. E-mail classes are discovered by importing
+``emails`` modules of all installed apps.
+"""
+import re
+from django.conf import settings
+from django.template import TemplateDoesNotExist, TextNode
+from django.utils import translation
+from django.utils.importlib import import_module
+from django.utils.module_loading import module_has_submodule
+from . import templates
+from .base import get_builders
+from .utils import get_css_inline_function, get_context_processors
+from .utils import get_url_function
+
+
+_style_re = re.compile(r'<style[^>]*>(.*?)</style>', re.S | re.I)
+
+
+def autodiscover(module_name='emails'):
+    """
+    Imports `module_name` modules of all installed apps, so e-mail classes
+    defined there get registered.
+    """
+    for app in settings.INSTALLED_APPS:
+        mod = import_module(app)
+        try:
+            import_module('%s.%s' % (app, module_name))
+        except ImportError:
+            if module_has_submodule(mod, module_name):
+                raise
+
+
+def warm_stylesheets(template, css_inline_fn):
+    """
+    Compiles stylesheets found in template's ``<style>`` tags if css is
+    inlined using an inliner (see `classymail.inline.BaseInliner`).
+
+    Only stylesheets without template tags and variables are compiled.
+    """
+    warm = getattr(css_inline_fn, 'warm', None)
+    if warm is None:
+        return
+    for node in template.nodelist.get_nodes_by_type(TextNode):
+        for css in _style_re.findall(node.s):
+            warm(css)
+
+
+def warmup_builder(builder_class):
+    """
+    Compiles templates (and their stylesheets) used by `builder_class`.
+
+    Returns True if there was anything to warm up.
+    """
+    css_inline_fn = get_css_inline_function()
+    warmed = False
+    for attr in ('html_template_name', 'text_template_name'):
+        template_name = getattr(builder_class, attr, None)
+        if not template_name:
+            continue
+        try:
+            template = templates.get_template(template_name)
+        except TemplateDoesNotExist:
+            continue
+        if attr == 'html_template_name':
+            warm_stylesheets(template, css_inline_fn)
+        warmed = True
+    return warmed
+
+
+def warmup(discover=True):
+    """
+    Resolves CLASSYMAIL_* settings and compiles templates of all registered
+    e-mail classes (for the default language).
+
+    Returns list of warmed up classes.
+    """
+    if discover:
+        autodiscover()
+    get_css_inline_function()
+    get_context_processors()
+    get_url_function()
+
+    warmed = []
+    with translation.override(settings.LANGUAGE_CODE):
+        for path, builder_class in sorted(get_builders().items()):
+            if warmup_builder(builder_class):
+                warmed.append(builder_class)
+    return warmed
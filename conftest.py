@@ -1,7 +1,74 @@
 import os
-from django.conf import settings
+import pytest
+from django.conf import settings as django_settings
 
 
 def pytest_configure():
-    if not settings.configured:
+    if not django_settings.configured:
         os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+
+
+class SettingsWrapper(object):
+    """
+    Changes settings for a single test and sends `setting_changed` signal
+    (just like `override_settings` does) so cached values are invalidated.
+    """
+    _missing = object()
+
+    def __init__(self):
+        object.__setattr__(self, '_original', {})
+
+    def _changed(self, name, value):
+        from classymail.utils import get_setting_changed_signal
+        get_setting_changed_signal().send(sender=django_settings._wrapped.__class__,
+                             setting=name, value=value)
+
+    def __getattr__(self, name):
+        return getattr(django_settings, name)
+
+    def __setattr__(self, name, value):
+        self._original.setdefault(
+            name, getattr(django_settings, name, self._missing))
+        setattr(django_settings, name, value)
+        self._changed(name, value)
+
+    def __delattr__(self, name):
+        self._original.setdefault(
+            name, getattr(django_settings, name, self._missing))
+        delattr(django_settings, name)
+        self._changed(name, None)
+
+    def restore(self):
+        for name, value in self._original.items():
+            if value is self._missing:
+                if hasattr(django_settings, name):
+                    delattr(django_settings, name)
+                value = None
+            else:
+                setattr(django_settings, name, value)
+            self._changed(name, value)
+
+
+@pytest.fixture
+def settings(request):
+    """
+    A Django settings object which restores changes after the test.
+    """
+    wrapper = SettingsWrapper()
+    request.addfinalizer(wrapper.restore)
+    return wrapper
+
+
+@pytest.fixture(autouse=True)
+def clear_classymail_caches():
+    """
+    Makes sure values cached by one test are not visible in other tests.
+    """
+    from classymail import attachments, base, mixins, templates, utils
+    attachments._parts.clear()
+    base._built.clear()
+    attachments._images.clear()
+    mixins._processor_results.clear()
+    mixins._skeletons.clear()
+    templates.clear()
+    utils.clear_caches()
@@ -8,7 +8,11 @@ setup(
     author='Rafal Stozek',
     license='BSD',
 
-    packages=['classymail', 'classymail.templatetags'],
+    packages=['classymail', 'classymail.templatetags',
+              'classymail.management', 'classymail.management.commands',
+              'classymail.contrib', 'classymail.contrib.outbox',
+              'classymail.contrib.outbox.migrations',
+              'classymail.contrib.outbox.south_migrations'],
 
     install_requires=[
         'premailer',
@@ -0,0 +1,17 @@
+from classymail import ClassyMail, EmailBuilder
+
+
+class TestMail(ClassyMail):
+    html_template_name = 'classymail/styled.html'
+    text_template_name = 'classymail/email.txt'
+
+
+class PrefetchingMail(EmailBuilder):
+    """Uses number of builders in a chunk as a body"""
+    @classmethod
+    def prefetch(cls, builders):
+        for builder in builders:
+            builder.prefetched = len(builders)
+
+    def get_body(self):
+        return 'Chunk of %s' % self.prefetched
@@ -23,6 +23,7 @@ INSTALLED_APPS = (
     'django.contrib.sites',
 
     'classymail',
+    'classymail.contrib.outbox',
     'tests',
 )
 
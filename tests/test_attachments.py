@@ -0,0 +1,53 @@
+import mock
+from classymail import EmailBuilder
+from classymail import attachments
+
+
+class TestAttachments(object):
+    def test_file_attachment(self, tmpdir):
+        path = tmpdir.join('report.pdf')
+        path.write('%PDF content', mode='wb')
+        attachment = attachments.FileAttachment(str(path))
+        assert attachment.filename == 'report.pdf'
+        assert attachment.mimetype == 'application/pdf'
+        assert attachment.read() == '%PDF content'
+
+    def test_buffer_attachment(self):
+        attachment = attachments.BufferAttachment(
+            memoryview(b'data'), 'data.bin')
+        assert attachment.mimetype == 'application/octet-stream'
+        assert attachment.read() == b'data'
+
+    def test_mime_part_is_created_once(self):
+        attachment = attachments.BufferAttachment(b'data', 'data.bin')
+        with mock.patch.object(attachment, 'read',
+                               return_value=b'data') as read:
+            part = attachment.get_mime_part()
+            assert attachment.get_mime_part() is part
+        assert read.call_count == 1
+        assert part.get_payload(decode=True) == b'data'
+        assert part['Content-Disposition'] == \
+            'attachment; filename="data.bin"'
+
+    def test_shared_attachment_in_messages(self):
+        attachment = attachments.BufferAttachment(b'data', 'data.bin')
+        messages = [EmailBuilder(to=['test@example.com'], body='Test',
+                                 attachments=[attachment]).build()
+                    for i in range(2)]
+        assert messages[0].attachments[0] is messages[1].attachments[0]
+        assert 'ZGF0YQ==' in messages[0].message().as_string()
+
+    def test_identical_content_is_encoded_once(self):
+        with mock.patch.object(attachments, 'create_mime_part',
+                               wraps=attachments.create_mime_part) as create:
+            messages = [EmailBuilder(
+                to=['test@example.com'], body='Test',
+                attachments=[('terms.pdf', b'%PDF', 'application/pdf')],
+            ).build() for i in range(2)]
+        assert create.call_count == 1
+        assert messages[0].attachments[0] is messages[1].attachments[0]
+
+    def test_different_filenames_are_not_shared(self):
+        first = attachments.get_mime_part('a.txt', 'data', 'text/plain')
+        second = attachments.get_mime_part('b.txt', 'data', 'text/plain')
+        assert first is not second
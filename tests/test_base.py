@@ -1,4 +1,5 @@
 import copy
+import mock
 import pytest
 from django.core import mail
 from django.utils import translation, functional
@@ -62,3 +63,139 @@ class TestEmailBuilderClass(object):
     def test_invalid_keyword_argument(self):
         with pytest.raises(TypeError):
             EmailBuilder(invalid_keyword_argument=1)
+
+
+class TestBulkSending(object):
+    def test_build_many(self):
+        ret = EmailBuilder.build_many(
+            {'to': [email], 'body': 'Test'}
+            for email in ['a@example.com', 'b@example.com'])
+        assert not isinstance(ret, list)
+        assert [msg.to for msg in ret] == [['a@example.com'],
+                                           ['b@example.com']]
+
+    def test_send_many(self):
+        results = EmailBuilder.send_many(
+            [{'to': ['a@example.com']}, {'to': ['b@example.com']}])
+        assert [r.sent for r in results] == [True, True]
+        assert [msg.to for msg in mail.outbox] == [['a@example.com'],
+                                                   ['b@example.com']]
+
+    def test_send_many_uses_single_connection(self):
+        connection = mock.Mock()
+        connection.open.return_value = True
+        EmailBuilder.send_many(
+            [{'to': ['test%d@example.com' % i]} for i in range(5)],
+            connection=connection, chunk_size=2)
+
+        connection.open.assert_called_once_with()
+        connection.close.assert_called_once_with()
+        sizes = [len(call[0][0])
+                 for call in connection.send_messages.call_args_list]
+        assert sizes == [1, 1, 1, 1, 1]
+
+    def test_send_many_failures(self):
+        results = EmailBuilder.send_many(
+            [{'to': ['a@example.com']}, {'invalid': 1}, {'to': []}])
+        assert [r.sent for r in results] == [True, False, False]
+        assert isinstance(results[1].error, TypeError)
+        assert results[1].message is None
+        assert isinstance(results[2].error, ValueError)
+        assert len(mail.outbox) == 1
+
+    def test_send_many_connection_error(self):
+        connection = mock.Mock()
+        connection.send_messages.side_effect = IOError()
+        results = EmailBuilder.send_many(
+            [{'to': ['a@example.com']}, {'to': ['b@example.com']}],
+            connection=connection)
+        assert [r.sent for r in results] == [False, False]
+        assert all(isinstance(r.error, IOError) for r in results)
+
+    def test_send_many_partial_failure(self):
+        """Messages are sent separately, so one rejected message doesn't
+        mark others as failed"""
+        def send_messages(messages):
+            if messages[0].to == ['c@example.com']:
+                raise IOError()
+            mail.outbox.extend(messages)
+            return len(messages)
+
+        connection = mock.Mock()
+        connection.send_messages.side_effect = send_messages
+        results = EmailBuilder.send_many(
+            [{'to': ['%s@example.com' % c]} for c in 'abcd'],
+            connection=connection)
+        assert [r.sent for r in results] == [True, True, False, True]
+        assert isinstance(results[2].error, IOError)
+        assert [m.to for m in mail.outbox] == [
+            ['a@example.com'], ['b@example.com'], ['d@example.com']]
+        assert connection.open.call_count == 1
+
+    def test_prefetch(self):
+        from tests.emails import PrefetchingMail
+        with mock.patch.object(PrefetchingMail, 'prefetch',
+                               wraps=PrefetchingMail.prefetch) as prefetch:
+            messages = list(PrefetchingMail.build_many(
+                [{'to': ['test%d@example.com' % i]} for i in range(3)],
+                chunk_size=2))
+        assert prefetch.call_count == 2
+        assert [msg.body for msg in messages] == ['Chunk of 2', 'Chunk of 2',
+                                                  'Chunk of 1']
+
+    def test_send_prefetches_single_builder(self):
+        from tests.emails import PrefetchingMail
+        PrefetchingMail.send(to=['a@example.com'])
+        assert mail.outbox[0].body == 'Chunk of 1'
+
+    def test_send_many_prefetch_error(self):
+        from tests.emails import PrefetchingMail
+        with mock.patch.object(PrefetchingMail, 'prefetch',
+                               side_effect=IOError()):
+            results = PrefetchingMail.send_many(
+                [{'to': ['a@example.com']}, {'invalid': 1}])
+        assert [r.sent for r in results] == [False, False]
+        assert isinstance(results[0].error, IOError)
+        assert isinstance(results[1].error, TypeError)
+        assert len(mail.outbox) == 0
+
+
+class TestBuildCache(object):
+    class CachedBuilder(EmailBuilder):
+        def get_build_cache_key(self):
+            return tuple(self.to)
+
+    def test_message_is_built_once(self):
+        with mock.patch.object(self.CachedBuilder, 'get_message',
+                               autospec=True,
+                               side_effect=EmailBuilder.get_message) \
+                as get_message:
+            first = self.CachedBuilder(to=['a@example.com'],
+                                       body='Test').build()
+            second = self.CachedBuilder(to=['a@example.com']).build()
+        assert get_message.call_count == 1
+        assert first.raw == second.raw
+        assert second.to == ['a@example.com']
+        assert second.message().get_payload() == 'Test'
+
+    def test_date_and_message_id_are_refreshed(self):
+        msg = self.CachedBuilder(to=['a@example.com']).build()
+        assert msg.message()['Message-ID'] != msg.message()['Message-ID']
+
+    def test_timeout(self):
+        builder = self.CachedBuilder(to=['a@example.com'])
+        with mock.patch('time.time', return_value=1000):
+            builder.build()
+        with mock.patch.object(builder, 'get_message',
+                               wraps=builder.get_message) as get_message:
+            with mock.patch('time.time', return_value=1299):
+                builder.build()
+            assert get_message.call_count == 0
+            with mock.patch('time.time', return_value=1301):
+                builder.build()
+            assert get_message.call_count == 1
+
+    def test_without_key(self):
+        msg = EmailBuilder(to=['a@example.com']).build()
+        assert isinstance(msg, mail.EmailMessage)
+        assert not hasattr(msg, 'raw')
@@ -0,0 +1,27 @@
+import os
+from classymail import bench
+
+
+class TestBench(object):
+    def test_run_benchmarks(self):
+        report = bench.run_benchmarks(messages=[3], sizes=[2])
+        names = [result['name'] for result in report['results']]
+        assert names == [name for name, setup in bench.BENCHMARKS]
+        for result in report['results']:
+            assert result['messages'] == 3 and result['size'] == 2
+            assert result['p50_ms'] <= result['p99_ms']
+            assert result['max_rss_kb'] > 0
+
+    def test_max_rss_of_child_process(self, monkeypatch):
+        """Every benchmark reports max RSS of its own process"""
+        monkeypatch.setattr(bench, 'tracemalloc', None)
+        # reports pid of the process which measured max RSS
+        monkeypatch.setattr(bench, '_max_rss', os.getpid)
+        result = bench.run_in_child(bench.bench_email_builder, 1, 1)
+        assert result['peak_memory_kb'] is None
+        assert result['max_rss_kb'] != os.getpid()
+
+    def test_percentile(self):
+        values = list(range(101))
+        assert bench.percentile(values, 0.5) == 50
+        assert bench.percentile(values, 0.99) == 99
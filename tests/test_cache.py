@@ -0,0 +1,37 @@
+from classymail.cache import LRUCache
+
+
+class TestLRUCache(object):
+    def test_least_recently_used_items_are_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert 'a' in cache and 'c' in cache
+        assert 'b' not in cache
+
+    def test_maxbytes(self):
+        cache = LRUCache(maxsize=None, maxbytes=10)
+        cache.set('a', 'a', size=4)
+        cache.set('b', 'b', size=4)
+        cache.set('c', 'c', size=4)
+        assert 'a' not in cache
+        assert cache.size == 8
+
+        cache.set('b', 'b', size=2)
+        assert cache.size == 6
+
+    def test_items_bigger_than_maxbytes_are_not_stored(self):
+        cache = LRUCache(maxbytes=10)
+        cache.set('a', 'a', size=4)
+        cache.set('big', 'big', size=11)
+        assert 'big' not in cache
+        assert 'a' in cache
+
+    def test_clear(self):
+        cache = LRUCache(maxbytes=10)
+        cache.set('a', 'a', size=4)
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.size == 0
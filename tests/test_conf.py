@@ -0,0 +1,30 @@
+import pytest
+from classymail import conf
+
+
+class TestConfig(object):
+    def test_defaults(self):
+        config = conf.Config()
+        assert config.CSS_INLINE_FUNCTION == 'premailer.transform'
+        assert config.DOMAIN is None
+
+    def test_read_only(self):
+        config = conf.Config(DOMAIN='example.com')
+        with pytest.raises(AttributeError):
+            config.DOMAIN = 'spam'
+        with pytest.raises(AttributeError):
+            config.OTHER = 'spam'
+        with pytest.raises(TypeError):
+            conf.Config(OTHER='spam')
+
+    def test_rebuilt_when_setting_changes(self, settings):
+        settings.CLASSYMAIL_DOMAIN = 'spam'
+        config = conf.get_config()
+        assert config.DOMAIN == 'spam'
+        assert conf.get_config() is config
+
+        settings.CLASSYMAIL_DOMAIN = 'eggs'
+        assert conf.get_config().DOMAIN == 'eggs'
+
+        del settings.CLASSYMAIL_DOMAIN
+        assert conf.get_config().DOMAIN is None
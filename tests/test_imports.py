@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+
+HEAVY_MODULES = (
+    'premailer', 'lxml', 'cssselect', 'cssutils', 'django.db',
+    'django.contrib.sites.models', 'django.template.loader', 'django.test',
+)
+
+SCRIPT = """
+import sys
+import classymail
+print(','.join(sorted(name for name in %r if name in sys.modules)))
+""" % (HEAVY_MODULES,)
+
+
+class TestImports(object):
+    def test_heavy_modules_are_imported_lazily(self):
+        """
+        Importing classymail must not import heavy dependencies - they are
+        needed only when messages are built.
+        """
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path),
+                   DJANGO_SETTINGS_MODULE='tests.settings')
+        process = subprocess.Popen([sys.executable, '-c', SCRIPT], env=env,
+                                   stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        assert process.returncode == 0
+        assert output.strip() == ''
@@ -0,0 +1,159 @@
+import mock
+import pytest
+from lxml import etree
+from classymail import inline
+
+
+class TestInline(object):
+    def test_without_style_tags(self):
+        """Html without <style> tags is returned untouched"""
+        html = '<p>Nothing to do</p>'
+        assert inline.transform(html) is html
+
+    def test_basic_inlining(self):
+        ret = inline.transform(
+            '<html><head><style>b { color: red; }</style></head>'
+            '<body><b>test</b></body></html>')
+        assert ret == ('<html><head></head><body><b style="color:red">test'
+                       '</b></body></html>')
+
+    def test_specificity_and_inline_styles(self):
+        ret = inline.transform(
+            '<style>#a { color: blue } p.x { color: red !important } '
+            'p { color: green; margin: 0 }</style>'
+            '<p class="x" id="a" style="font-weight:bold">t</p>'
+            '<p style="color:pink">u</p>')
+        assert '<p class="x" id="a" style="color:red; margin:0; ' \
+               'font-weight:bold">t</p>' in ret
+        assert '<p style="color:pink; margin:0">u</p>' in ret
+
+    def test_leftover_rules(self):
+        """Pseudo-classes and at-rules are kept in <style> tag"""
+        ret = inline.transform(
+            '<style>a:hover, a { color: red } '
+            '@media (max-width: 600px) { a { color: blue } }</style>'
+            '<a href="#">link</a>')
+        assert '<a href="#" style="color:red">link</a>' in ret
+        assert '<style>a:hover {color: red}\n' \
+               '@media (max-width: 600px) { a { color: blue } }</style>' in ret
+
+    def test_ignored_style_tags(self):
+        """<style> tags for other media or marked as ignored are kept"""
+        ret = inline.transform(
+            '<style media="print">p { display: none }</style>'
+            '<style data-premailer="ignore">p { margin: 0 }</style>'
+            '<style media="all">p { color: red }</style><p>x</p>')
+        assert '<style media="print">p { display: none }</style>' in ret
+        assert '<style>p { margin: 0 }</style>' in ret
+        assert '<p style="color:red">x</p>' in ret
+
+    def test_structural_pseudo_classes(self):
+        """Structural pseudo-classes are inlined (premailer keeps
+        :nth-child() with arguments in <style> tag)"""
+        ret = inline.transform(
+            '<style>li:nth-child(2n) { color: red } li:hover { color: blue }'
+            '</style><ul><li>a</li><li>b</li></ul>')
+        assert '<li>a</li><li style="color:red">b</li>' in ret
+        assert '<style>li:hover {color: blue}</style>' in ret
+
+    def test_doctype_is_preserved(self):
+        ret = inline.transform('<!DOCTYPE html><style>b {color: red}</style>'
+                               '<b>test</b>')
+        assert ret.startswith('<!DOCTYPE html>\n<html>')
+
+    def test_stylesheet_is_compiled_once(self):
+        html = '<style>b { color: red }</style><b>test</b>'
+        inline.transform(html)
+        with mock.patch.object(inline, 'Stylesheet') as m:
+            ret = inline.transform(html)
+        assert not m.called
+        assert '<b style="color:red">test</b>' in ret
+
+    def test_parse_declarations(self):
+        ret = inline.parse_declarations(
+            'Color: red !important; background: url("a;b.png");;')
+        assert ret == [('color', 'red', True),
+                       ('background', 'url("a;b.png")', False)]
+
+
+class TestInliners(object):
+    def test_base_inliner_is_callable(self):
+        class Upper(inline.BaseInliner):
+            def inline(self, html):
+                return html.upper()
+        assert Upper()('<b>a</b>') == '<B>A</B>'
+
+    def test_premailer_inliner_passes_options(self):
+        with mock.patch('premailer.Premailer') as m:
+            inline.PremailerInliner(keep_style_tags=True).inline('<b>a</b>')
+        m.assert_called_once_with('<b>a</b>', keep_style_tags=True)
+
+    def test_fast_inliner_keeps_own_cache(self):
+        inliner = inline.FastInliner(cache_size=1)
+        inliner.warm('b { color: red }')
+        inliner.warm('i { color: red }')
+        assert len(inliner.stylesheets) == 1
+        assert inline.FastInliner().stylesheets is not inliner.stylesheets
+
+
+class TestCachedInliner(object):
+    def test_same_html_is_inlined_once(self):
+        from classymail.utils import get_cache
+        cache = get_cache('default')
+        cache.clear()
+        inline_fn = mock.Mock(return_value='<b style="color:red">a</b>')
+        inliner = inline.CachedInliner(inline_fn, cache)
+        html = '<style>b { color: red }</style><b>a</b>'
+        assert inliner(html) == '<b style="color:red">a</b>'
+        assert inliner(html) == '<b style="color:red">a</b>'
+        assert inline_fn.call_count == 1
+        assert cache.get(inliner.get_key(html)) == '<b style="color:red">a</b>'
+
+    def test_warm_is_passed_to_wrapped_inliner(self):
+        wrapped = inline.FastInliner()
+        inline.CachedInliner(wrapped, mock.Mock()).warm('b { color: red }')
+        assert len(wrapped.stylesheets) == 1
+
+
+CONFORMANCE_CASES = [
+    '<style>p { color: red }</style><p>a</p>',
+    '<style>.a { color: red } #b { color: blue } p { color: green }</style>'
+    '<p class="a" id="b">a</p><p class="a">b</p>',
+    '<style>div p { color: red } div > span { margin: 0 }</style>'
+    '<div><p>x</p><span>y</span></div><p>z</p>',
+    '<style>p { color: red !important } p.x { color: blue }</style>'
+    '<p class="x">x</p>',
+    '<style>p { color: red; margin: 0 }</style><p style="color: blue">x</p>',
+    '<style>h1, h2 { color: red }</style><h1>x</h1><h2>y</h2>',
+    '<style>a:hover { color: red } a { color: blue }</style>'
+    '<a href="#">x</a>',
+    '<style>.a.b { color: red } [title] { margin: 0 }</style>'
+    '<p class="a b" title="t">x</p>',
+    '<style>p { color: red } p { color: blue }</style><p>x</p>',
+    '<style media="print">p { display: none }</style><p>x</p>',
+    '<style media="screen and (max-width: 600px)">p { width: 100% }</style>'
+    '<style>p { color: red }</style><p>x</p>',
+    '<style media="screen">p { color: red }</style><p>x</p>',
+    '<style data-premailer="ignore">p { color: red }</style><p>x</p>',
+    '<style>li:first-child { color: red } li:last-child { margin: 0 }</style>'
+    '<ul><li>a</li><li>b</li><li>c</li></ul>',
+    '<style>li:first-child:hover { color: red } p::before { content: "x" }'
+    '</style><ul><li>a</li></ul><p>b</p>',
+]
+
+
+def _element_styles(html):
+    root = etree.fromstring(html, etree.HTMLParser())
+    return [(element.tag,
+             sorted(inline.parse_declarations(element.get('style', ''))))
+            for element in root.iter()
+            if isinstance(element.tag, basestring) and element.tag != 'style']
+
+
+class TestConformance(object):
+    """FastInliner sets the same styles as premailer"""
+    @pytest.mark.parametrize('html', CONFORMANCE_CASES)
+    def test_same_styles_as_premailer(self, html):
+        fast = inline.FastInliner().inline(html)
+        expected = inline.PremailerInliner().inline(html)
+        assert _element_styles(fast) == _element_styles(expected)
@@ -1,9 +1,12 @@
+import time
 from contextlib import nested
+import mock
 import pytz
 import pytest
 from django.core import mail
 from django.contrib.sites.models import Site
 from django.core.exceptions import ImproperlyConfigured
+from django.template import TemplateSyntaxError
 from django.utils import translation, timezone
 from classymail import mixins
 
@@ -62,6 +65,61 @@ class TestLocalizationMixin(object):
             assert timezone.get_current_timezone() == berlin
             assert translation.get_language() == 'de'
 
+    def test_build_chunk_groups_by_locale(self, monkeypatch):
+        calls = []
+        override_locale = mixins.override_locale
+
+        def counting_override_locale(*args):
+            calls.append(args)
+            return override_locale(*args)
+        monkeypatch.setattr(mixins, 'override_locale',
+                            counting_override_locale)
+
+        class Builder(mixins.LocalizationMixin):
+            def get_message(self):
+                return translation.get_language()
+
+        builders = [Builder(language=lang) for lang in ['pl', 'de', 'pl']]
+        results = Builder.build_chunk(builders)
+        assert [r.message for r in results] == ['pl', 'de', 'pl']
+        assert [r.builder for r in results] == builders
+        assert calls == [(None, 'pl'), (None, 'de')]
+
+        results = Builder.build_chunk(builders, preserve_order=False)
+        assert [r.message for r in results] == ['pl', 'pl', 'de']
+
+    def test_build_chunk_calls_build_overrides(self, monkeypatch):
+        calls = []
+        override_locale = mixins.override_locale
+
+        def counting_override_locale(*args):
+            calls.append(args)
+            return override_locale(*args)
+        monkeypatch.setattr(mixins, 'override_locale',
+                            counting_override_locale)
+
+        class Builder(mixins.LocalizationMixin):
+            def build(self):
+                return 'overridden %s' % super(Builder, self).build()
+
+            def get_message(self):
+                return translation.get_language()
+
+        builders = [Builder(language=lang) for lang in ['pl', 'pl']]
+        results = Builder.build_chunk(builders)
+        assert [r.message for r in results] == ['overridden pl'] * 2
+        assert calls == [(None, 'pl')]
+        assert not any(builder._locale_active for builder in builders)
+
+    def test_build_many(self):
+        with translation.override('de'):
+            ret = mixins.LocalizationMixin.build_many(
+                [{'language': 'pl', 'to': ['a@example.com']},
+                 {'to': ['b@example.com']}])
+            assert [msg.to for msg in ret] == [['a@example.com'],
+                                               ['b@example.com']]
+            assert translation.get_language() == 'de'
+
 
 class TestContextMixin(object):
     def test_default_context_data(self):
@@ -100,6 +158,17 @@ class TestSiteMixin(object):
         mixin = mixins.SiteMixin()
         assert mixin.get_site() is None
 
+    def test_site_and_domain_resolved_once(self, monkeypatch):
+        get_current = mock.Mock(return_value=Site(domain='test', name='test'))
+        monkeypatch.setattr(Site.objects, 'get_current', get_current)
+
+        mixin = mixins.SiteMixin()
+        assert mixin.get_site() is mixin.get_site()
+        assert mixin.get_domain() == 'test'
+        # current site is also shared between builders
+        assert mixins.SiteMixin().get_domain() == 'test'
+        assert get_current.call_count == 1
+
     def test_context_data(self):
         """Checks if 'site' has been added to context"""
         mixin = mixins.SiteMixin(site=Site(domain='test', name='test'))
@@ -145,6 +214,12 @@ class TestHtmlAndTextTemplateMixin(object):
         ret = builder.render_text_template({})
         assert ret.strip() == 'This is a test'
 
+    def test_list_of_template_names(self):
+        builder = mixins.HtmlAndTextTemplateMixin(
+            text_template_name=('classymail/missing.txt',
+                                'classymail/email.txt'))
+        assert builder.render_text_template({}).strip() == 'This is a test'
+
     def test_creating_message(self):
         mixins.HtmlAndTextTemplateMixin.send(
             text_template_name='classymail/email.txt',
@@ -185,3 +260,232 @@ class TestContextProcessorMixin(object):
         assert ctx['builder'] is mixin
         assert ctx['x'] == 1 and ctx['y'] == 2
         assert ctx['c'] == 3 and ctx['d'] == 4
+
+    def get_scoped_processor(self, monkeypatch, settings, scope, **kwargs):
+        from classymail.utils import context_processor_scope
+        from . import context_processors
+        processor = mock.Mock(return_value={'x': 1})
+        monkeypatch.setattr(context_processors, 'ctx_processor1',
+                            context_processor_scope(scope, **kwargs)(processor))
+        settings.CLASSYMAIL_CONTEXT_PROCESSORS = (
+            'tests.context_processors.ctx_processor1',)
+        return processor
+
+    def test_build_scope(self, monkeypatch, settings):
+        processor = self.get_scoped_processor(monkeypatch, settings, 'build')
+        mixins.ContextProcessorMixin().get_context_data()
+        mixins.ContextProcessorMixin().get_context_data()
+        assert processor.call_count == 2
+
+    def test_process_scope(self, monkeypatch, settings):
+        processor = self.get_scoped_processor(monkeypatch, settings, 'process')
+        for language in ('en', 'de'):
+            with translation.override(language):
+                ctx = mixins.ContextProcessorMixin().get_context_data()
+        assert ctx['x'] == 1
+        assert processor.call_count == 1
+
+    def test_locale_scope(self, monkeypatch, settings):
+        processor = self.get_scoped_processor(monkeypatch, settings, 'locale')
+        for language in ('en', 'de', 'en'):
+            with translation.override(language):
+                mixins.ContextProcessorMixin().get_context_data()
+        assert processor.call_count == 2
+
+    def test_timeout(self, monkeypatch, settings):
+        processor = self.get_scoped_processor(monkeypatch, settings,
+                                              'process', timeout=60)
+        with mock.patch('time.time', return_value=1000):
+            mixins.ContextProcessorMixin().get_context_data()
+        with mock.patch('time.time', return_value=1059):
+            mixins.ContextProcessorMixin().get_context_data()
+        assert processor.call_count == 1
+        with mock.patch('time.time', return_value=1061):
+            mixins.ContextProcessorMixin().get_context_data()
+        assert processor.call_count == 2
+
+    def test_unknown_scope(self):
+        from classymail.utils import context_processor_scope
+        with pytest.raises(ValueError):
+            context_processor_scope('request')
+
+
+class TestPersonalizedTemplateMixin(object):
+    class Builder(mixins.PersonalizedTemplateMixin):
+        html_template_name = 'classymail/personalized.html'
+        text_template_name = 'classymail/personalized.txt'
+        shared_context_keys = ('company',)
+        personalized_context_keys = ('user',)
+        extra_context = {'company': 'ACME'}
+        user = None
+        plan = None
+
+        def get_context_data(self):
+            data = super(TestPersonalizedTemplateMixin.Builder,
+                         self).get_context_data()
+            data['user'] = self.user
+            data['plan'] = self.plan
+            return data
+
+    def test_templates_rendered_once(self, settings):
+        settings.CLASSYMAIL_CSS_INLINE_FUNCTION = 'classymail.inline.transform'
+        users = [mock.Mock(pk=1), mock.Mock(pk=2)]
+        users[0].name = 'Matt'
+        users[1].name = '<Anna>'
+
+        with mock.patch('classymail.mixins.render_to_string',
+                        wraps=mixins.render_to_string) as m:
+            messages = list(self.Builder.build_many(
+                [{'user': user, 'to': ['test@example.com']}
+                 for user in users]))
+        assert m.call_count == 2
+
+        assert messages[0].body == 'Hello Matt from ACME'
+        assert messages[1].body == 'Hello &lt;Anna&gt; from ACME'
+        html = messages[1].alternatives[0][0]
+        assert '<p style="color:red">Hello &lt;Anna&gt; from ACME</p>' in html
+        assert '<a href="/u/2/">' in html
+
+    def test_only_shared_context_is_rendered_once(self):
+        """Values which aren't shared or personalized don't leak between
+        messages"""
+        users = [mock.Mock(), mock.Mock()]
+        users[0].name, users[1].name = 'Ann', 'Bob'
+        messages = list(self.Builder.build_many(
+            [{'user': users[0], 'plan': 'pro', 'to': ['ann@example.com'],
+              'text_template_name': 'classymail/personalized/private.txt'},
+             {'user': users[1], 'plan': 'free', 'to': ['bob@example.com'],
+              'text_template_name': 'classymail/personalized/private.txt'}]))
+        assert messages[0].body == 'Ann  '
+        assert messages[1].body == 'Bob  '
+
+    def test_skeleton_key_includes_timezone(self):
+        builder = self.Builder()
+        with timezone.override('Europe/Warsaw'):
+            warsaw = builder.get_skeleton_key({})
+        assert warsaw != builder.get_skeleton_key({})
+
+    def test_skeleton_key_includes_shared_values(self):
+        """Templates are rendered again when shared values change"""
+        user = mock.Mock()
+        user.name = 'Ann'
+        kwargs = {'user': user, 'to': ['test@example.com']}
+        first = self.Builder(**kwargs).build()
+        second = self.Builder(extra_context={'company': 'Initech'},
+                              **kwargs).build()
+        assert first.body == 'Hello Ann from ACME'
+        assert second.body == 'Hello Ann from Initech'
+
+    def test_builder_cant_be_shared(self):
+        builder = self.Builder(to=['test@example.com'])
+        builder.shared_context_keys = ('builder',)
+        with pytest.raises(ImproperlyConfigured):
+            builder.build()
+
+    @pytest.mark.parametrize('template_name', [
+        'if.html', 'if_not.html', 'filter.html', 'tag.html', 'include.html'])
+    def test_placeholder_misuse(self, template_name):
+        user = mock.Mock(vip=False)
+        user.name = 'Ann'
+        builder = self.Builder(
+            user=user, to=['test@example.com'],
+            html_template_name='classymail/personalized/' + template_name)
+        with pytest.raises(TemplateSyntaxError):
+            builder.build()
+
+    def test_placeholder(self):
+        from classymail.utils import Placeholder
+        placeholder = Placeholder('user')
+        assert unicode(placeholder.profile['name']) == \
+            '~~classymail:user.profile.name~~'
+        assert not hasattr(placeholder, '_private')
+        with pytest.raises(TemplateSyntaxError):
+            bool(placeholder.vip)
+        with pytest.raises(TemplateSyntaxError):
+            placeholder.get_absolute_url()
+        assert len(placeholder._errors) == 2
+
+
+class TestInlineImagesMixin(object):
+    # 1x1 transparent gif
+    GIF = ('GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9'
+           '\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00'
+           '\x02\x02D\x01\x00;')
+
+    def get_builder(self, tmpdir, **kwargs):
+        path = tmpdir.join('logo.gif')
+        if not path.check():
+            path.write(self.GIF, mode='wb')
+        return mixins.InlineImagesMixin(
+            html_template_name='classymail/images.html',
+            text_template_name='classymail/email.txt',
+            inline_images={'/static/logo.gif': str(path)}, **kwargs)
+
+    def test_images_are_embedded(self, settings, tmpdir):
+        settings.CLASSYMAIL_CSS_INLINE_FUNCTION = None
+        msg = self.get_builder(tmpdir).build()
+        html = msg.alternatives[0][0]
+        part = msg.attachments[0]
+        cid = part['Content-ID'][1:-1]
+
+        assert msg.mixed_subtype == 'related'
+        assert len(msg.attachments) == 1
+        assert html.count('src="cid:%s"' % cid) == 1
+        assert "src='cid:%s'" % cid in html
+        assert 'src="/static/other.png"' in html
+        assert part.get_content_type() == 'image/gif'
+        assert 'multipart/related' in msg.message().as_string()
+
+    def test_image_is_encoded_once(self, settings, tmpdir):
+        settings.CLASSYMAIL_CSS_INLINE_FUNCTION = None
+        first = self.get_builder(tmpdir).build()
+        second = self.get_builder(tmpdir).build()
+        assert first.attachments[0] is second.attachments[0]
+
+    def test_without_images(self, settings):
+        settings.CLASSYMAIL_CSS_INLINE_FUNCTION = None
+        msg = mixins.InlineImagesMixin(
+            html_template_name='classymail/images.html',
+            text_template_name='classymail/email.txt').build()
+        assert not msg.attachments
+        assert msg.mixed_subtype == 'mixed'
+
+
+class TestConcurrentBuilding(object):
+    class Builder(mixins.LocalizationMixin, mixins.HtmlAndTextTemplateMixin):
+        html_template_name = 'classymail/email.html'
+        text_template_name = 'classymail/email.txt'
+
+        def get_subject(self):
+            # give other threads a chance to change their locale
+            time.sleep(0.001)
+            return '%s %s' % (translation.get_language(),
+                              timezone.get_current_timezone_name())
+
+    def test_mixed_locales(self, settings):
+        settings.CLASSYMAIL_CSS_INLINE_FUNCTION = None
+        locales = [('en', 'UTC'), ('de', 'Europe/Berlin'),
+                   ('pl', 'Europe/Warsaw')]
+        kwargs_list = [{'to': ['test%d@example.com' % i],
+                        'language': locales[i % 3][0],
+                        'timezone': pytz.timezone(locales[i % 3][1])}
+                       for i in range(30)]
+
+        with translation.override('en'):
+            messages = list(self.Builder.build_many(
+                kwargs_list, chunk_size=10, max_workers=4))
+            assert translation.get_language() == 'en'
+
+        assert len(messages) == 30
+        for i, message in enumerate(messages):
+            assert message.to == ['test%d@example.com' % i]
+            assert message.subject == '%s %s' % locales[i % 3]
+            assert message.body == 'This is a test'
+
+    def test_send_many(self):
+        results = mixins.LocalizationMixin.send_many(
+            [{'to': ['test%d@example.com' % i], 'language': language}
+             for i, language in enumerate(['en', 'de'] * 5)], max_workers=3)
+        assert all(result.sent for result in results)
+        assert [result.message.to for result in results] == \
+            [['test%d@example.com' % i] for i in range(10)]
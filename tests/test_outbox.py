@@ -0,0 +1,169 @@
+import mock
+import pytest
+from django.core import mail
+from django.core.management import call_command
+from classymail import EmailBuilder
+from classymail import outbox
+
+
+@pytest.fixture
+def sqlite_outbox(tmpdir, settings):
+    settings.CLASSYMAIL_OUTBOX = 'classymail.outbox.SQLiteOutbox'
+    settings.CLASSYMAIL_OUTBOX_OPTIONS = {'path': str(tmpdir.join('outbox'))}
+    return outbox.get_outbox()
+
+
+class TestSQLiteOutbox(object):
+    def test_put_and_claim(self, sqlite_outbox):
+        first = sqlite_outbox.put(('message', 'a'))
+        sqlite_outbox.put(('message', 'b'), delay=60)
+        assert sqlite_outbox.claim(10) == [(first, ('message', 'a'), 0)]
+        # claimed messages are hidden
+        assert sqlite_outbox.claim(10) == []
+
+    def test_retry_and_fail(self, sqlite_outbox):
+        id = sqlite_outbox.put(('message', 'a'))
+        sqlite_outbox.claim(10)
+        sqlite_outbox.retry(id, 0, IOError())
+        assert sqlite_outbox.claim(10) == [(id, ('message', 'a'), 1)]
+        sqlite_outbox.fail(id, IOError())
+        sqlite_outbox.retry(id, 0, IOError())
+        assert sqlite_outbox.claim(10) == []
+
+
+class TestDatabaseOutbox(object):
+    def test_put_and_claim(self, db):
+        box = outbox.DatabaseOutbox()
+        id = box.put(('message', 'a'))
+        assert box.claim(10) == [(id, ('message', 'a'), 0)]
+        assert box.claim(10) == []
+        box.retry(id, 0, IOError())
+        assert box.claim(10) == [(id, ('message', 'a'), 1)]
+        box.done(id)
+        box.retry(id, 0, IOError())
+        assert box.claim(10) == []
+
+
+class TestOutboxWorker(object):
+    def test_send_later(self, sqlite_outbox):
+        EmailBuilder.send_later(to=['a@example.com'], body='Later')
+        sqlite_outbox.put_message(
+            EmailBuilder(to=['b@example.com'], body='Built').build())
+        assert len(mail.outbox) == 0
+
+        worker = outbox.OutboxWorker(threads=2, batch_size=1)
+        assert worker.run(once=True) == 2
+        assert sorted(msg.to[0] for msg in mail.outbox) == \
+            ['a@example.com', 'b@example.com']
+        assert sqlite_outbox.claim(10) == []
+
+    def test_builders_are_prefetched(self, sqlite_outbox):
+        from tests.emails import PrefetchingMail
+        PrefetchingMail.send_later(to=['a@example.com'])
+        outbox.OutboxWorker(threads=1).run(once=True)
+        assert mail.outbox[0].body == 'Chunk of 1'
+
+    def test_retries_with_backoff(self, sqlite_outbox):
+        id = sqlite_outbox.put_builder(EmailBuilder, {'to': []})
+        worker = outbox.OutboxWorker(threads=1, max_attempts=2, backoff=10)
+        with mock.patch.object(sqlite_outbox, 'retry',
+                               wraps=sqlite_outbox.retry) as retry:
+            worker.run(once=True)
+        assert retry.call_args[0][:2] == (id, 10)
+        assert worker.sent == 0 and worker.failed == 0
+
+        sqlite_outbox.retry(id, 0, None)
+        worker.run(once=True)
+        assert worker.failed == 1
+        assert sqlite_outbox.claim(10) == []
+
+    def test_connection_is_reused(self, sqlite_outbox):
+        for i in range(3):
+            EmailBuilder.send_later(to=['test%d@example.com' % i])
+        connection = mock.Mock()
+        worker = outbox.OutboxWorker(threads=1, batch_size=2,
+                                     connection_factory=lambda: connection)
+        worker.run(once=True)
+        sizes = [len(call[0][0])
+                 for call in connection.send_messages.call_args_list]
+        assert sizes == [1, 1, 1]
+        # open() does nothing when the connection is already open
+        assert connection.open.call_count == 3
+        connection.close.assert_called_once_with()
+
+    def test_smtp_connection_is_kept_open(self, sqlite_outbox):
+        from django.core.mail.backends.smtp import EmailBackend
+        for i in range(3):
+            EmailBuilder.send_later(to=['test%d@example.com' % i])
+        with mock.patch('smtplib.SMTP') as smtp:
+            worker = outbox.OutboxWorker(
+                threads=1, batch_size=2, connection_factory=EmailBackend)
+            worker.run(once=True)
+        assert smtp.call_count == 1
+        assert smtp.return_value.sendmail.call_count == 3
+        smtp.return_value.quit.assert_called_once_with()
+
+    def test_only_failed_messages_are_retried(self, sqlite_outbox):
+        def send_messages(messages):
+            if messages[0].to == ['b@example.com']:
+                raise IOError()
+            mail.outbox.extend(messages)
+
+        for address in ['a@example.com', 'b@example.com', 'c@example.com']:
+            EmailBuilder.send_later(to=[address])
+        connection = mock.Mock()
+        connection.send_messages.side_effect = send_messages
+        worker = outbox.OutboxWorker(threads=1, batch_size=10, backoff=0,
+                                     connection_factory=lambda: connection)
+        with mock.patch.object(sqlite_outbox, 'retry',
+                               wraps=sqlite_outbox.retry) as retry:
+            worker.drain_batch(connection)
+        assert retry.call_count == 1
+        assert [msg.to for msg in mail.outbox] == [['a@example.com'],
+                                                   ['c@example.com']]
+        # the connection is opened again for the next batch
+        connection.close.assert_called_once_with()
+
+    def test_command(self, sqlite_outbox):
+        EmailBuilder.send_later(to=['a@example.com'])
+        call_command('classymail_drain', once=True, threads=1)
+        assert len(mail.outbox) == 1
+
+    def test_errors_are_retried(self, sqlite_outbox):
+        EmailBuilder.send_later(to=['a@example.com'])
+        worker = outbox.OutboxWorker(threads=1, poll_interval=0)
+        claim = worker.outbox.claim
+        calls = []
+
+        def flaky_claim(limit):
+            calls.append(limit)
+            if len(calls) == 1:
+                raise ValueError('database is down')
+            if len(calls) == 3:
+                worker.stop()
+            return claim(limit)
+
+        worker.outbox.claim = flaky_claim
+        assert worker.run() == 1
+        assert worker.errors == []
+        assert len(mail.outbox) == 1
+
+    def test_errors_are_raised_with_once(self, sqlite_outbox):
+        EmailBuilder.send_later(to=['a@example.com'])
+        worker = outbox.OutboxWorker(threads=2)
+        worker.outbox.claim = mock.Mock(side_effect=ValueError('down'))
+        with pytest.raises(ValueError):
+            worker.run(once=True)
+        assert worker.errors
+
+    def test_command_fails_when_connection_fails(self, sqlite_outbox):
+        EmailBuilder.send_later(to=['a@example.com'])
+        connection = mock.Mock()
+        connection.open.side_effect = IOError('smtp is down')
+        with mock.patch('classymail.outbox.mail.get_connection',
+                        return_value=connection):
+            # CommandError makes the command exit with status 1
+            with pytest.raises(SystemExit) as excinfo:
+                call_command('classymail_drain', once=True, threads=1)
+        assert excinfo.value.code == 1
+        assert mail.outbox == []
@@ -0,0 +1,107 @@
+import mock
+from django.core import mail
+from classymail import EmailBuilder, HtmlAndTextTemplateMixin
+from classymail.message import RawMessage
+from classymail.parallel import AsyncSender, build_in_processes
+from classymail.parallel import send_in_processes
+
+
+class TestRawMessage(object):
+    def test_from_message(self):
+        msg = EmailBuilder(to=['a@example.com'], cc=['b@example.com'],
+                           subject='Test', body='Test body').build()
+        raw = RawMessage.from_message(msg)
+        assert raw.recipients() == ['a@example.com', 'b@example.com']
+        assert raw.message()['Subject'] == 'Test'
+        assert raw.message().get_payload() == 'Test body'
+
+    def test_from_lines_are_not_mangled(self):
+        msg = EmailBuilder(to=['a@example.com'],
+                           body='Hello\nFrom here on').build()
+        raw = RawMessage.from_message(msg)
+        assert '\nFrom here on' in raw.message().as_string()
+        assert '>From' not in raw.message().as_string()
+
+
+class TestProcessPool(object):
+    def test_connections_are_closed_before_forking(self):
+        calls = []
+        with mock.patch('classymail.parallel.close_db_connections',
+                        side_effect=lambda: calls.append('close')):
+            with mock.patch('multiprocessing.Pool',
+                            side_effect=lambda *a, **kw: calls.append('fork')
+                            or mock.MagicMock()):
+                list(build_in_processes(EmailBuilder, []))
+        assert calls == ['close', 'fork']
+
+    def test_build_in_processes(self):
+        kwargs_list = [{'to': ['test%d@example.com' % i],
+                        'text_template_name': 'classymail/email.txt',
+                        'html_template_name': 'classymail/email.html'}
+                       for i in range(5)]
+        kwargs_list.append({'to': ['fail@example.com']})
+
+        results = list(build_in_processes(HtmlAndTextTemplateMixin,
+                                          kwargs_list, processes=2))
+        assert len(results) == 6
+        for i, (message, error) in enumerate(results[:5]):
+            assert error is None
+            assert message.to == ['test%d@example.com' % i]
+            parts = message.message().get_payload()
+            assert parts[0].get_payload() == 'This is a test'
+        # templates are not set
+        assert results[5][0] is None and results[5][1] is not None
+
+    def test_build_in_processes_prefetch(self):
+        from tests.emails import PrefetchingMail
+        results = list(build_in_processes(
+            PrefetchingMail, [{'to': ['a@example.com']}, {'invalid': 1},
+                              {'to': ['b@example.com']}],
+            processes=2, chunksize=3))
+        assert results[0][0].message().get_payload() == 'Chunk of 2'
+        assert isinstance(results[1][1], TypeError)
+        assert results[2][0].to == ['b@example.com']
+
+    def test_send_in_processes(self):
+        results = send_in_processes(
+            EmailBuilder, [{'to': ['a@example.com'], 'body': 'Test'},
+                           {'to': []}], processes=2)
+        assert [result.sent for result in results] == [True, False]
+        assert len(mail.outbox) == 1
+        assert mail.outbox[0].message().get_payload() == 'Test'
+
+
+class TestAsyncSender(object):
+    def test_send(self):
+        sender = AsyncSender(max_workers=2)
+        callback = mock.Mock()
+        results = [sender.send(EmailBuilder, to=['a@example.com'], body='A'),
+                   sender.send(EmailBuilder, callback=callback,
+                               to=['b@example.com'], body='B'),
+                   sender.send(EmailBuilder, invalid=1)]
+        sender.close()
+
+        results = [result.get() for result in results]
+        assert [result.sent for result in results] == [True, True, False]
+        assert isinstance(results[2].error, TypeError)
+        callback.assert_called_once_with(results[1])
+        assert sorted(msg.body for msg in mail.outbox) == ['A', 'B']
+
+    def test_builders_are_prefetched(self):
+        from tests.emails import PrefetchingMail
+        sender = AsyncSender(max_workers=1)
+        result = sender.build(PrefetchingMail, to=['a@example.com'])
+        sender.close()
+        assert result.get().message.body == 'Chunk of 1'
+
+    def test_build_and_send_many(self):
+        sender = AsyncSender(max_workers=2)
+        built = sender.build(EmailBuilder, to=['a@example.com'])
+        sent = sender.send_many(EmailBuilder, [{'to': ['b@example.com']},
+                                               {'to': ['c@example.com']}],
+                                chunk_size=1)
+        sender.close()
+
+        assert built.get().message.to == ['a@example.com']
+        assert [result.sent for result in sent.get()] == [True, True]
+        assert len(mail.outbox) == 2
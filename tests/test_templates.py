@@ -0,0 +1,49 @@
+import os
+import mock
+from django.template import loader
+from classymail import templates
+
+
+class TestTemplateCache(object):
+    def test_template_compiled_once(self):
+        with mock.patch.object(loader, 'get_template',
+                               wraps=loader.get_template) as m:
+            ret = templates.render_to_string('classymail/email.txt', {})
+            ret2 = templates.render_to_string('classymail/email.txt', {})
+        assert ret == ret2 == 'This is a test'
+        assert m.call_count == 1
+
+    def test_list_of_template_names(self):
+        """The first existing template is used, like in django"""
+        names = ['classymail/missing.txt', 'classymail/email.txt']
+        with mock.patch.object(loader, 'select_template',
+                               wraps=loader.select_template) as m:
+            ret = templates.render_to_string(names, {})
+            ret2 = templates.render_to_string(tuple(names), {})
+        assert ret == ret2 == 'This is a test'
+        assert m.call_count == 1
+
+    def test_template_recompiled_when_changed(self, settings, tmpdir):
+        settings.TEMPLATE_DIRS = (str(tmpdir),)
+        source = tmpdir.join('test.txt')
+        source.write('first')
+        assert templates.render_to_string('test.txt', {}) == 'first'
+
+        source.write('second')
+        mtime = os.path.getmtime(str(source))
+        os.utime(str(source), (mtime + 10, mtime + 10))
+        assert templates.render_to_string('test.txt', {}) == 'second'
+
+    def test_warm_and_clear(self):
+        templates.warm(['classymail/email.txt'])
+        with mock.patch.object(loader, 'get_template') as m:
+            templates.get_template('classymail/email.txt')
+            assert not m.called
+
+            templates.clear()
+            templates.get_template('classymail/email.txt')
+            assert m.called
+
+    def test_get_template_mtime(self):
+        assert templates.get_template_mtime('classymail/email.txt') > 0
+        assert templates.get_template_mtime('classymail/missing.txt') is None
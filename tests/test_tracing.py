@@ -0,0 +1,66 @@
+import mock
+import pytest
+from classymail import tracing, mixins
+
+
+class TestTracing(object):
+    def test_disabled_by_default(self):
+        assert tracing.get_tracer() is None
+        fn = mock.Mock(return_value='test')
+        assert tracing.traced('stage', None, fn, 1, a=2) == 'test'
+        fn.assert_called_once_with(1, a=2)
+
+    def test_stages_are_traced(self):
+        stats = tracing.StatsTracer()
+        tracing.set_tracer(stats)
+        try:
+            mixins.HtmlAndTextTemplateMixin.send(
+                text_template_name='classymail/email.txt',
+                html_template_name='classymail/email.html',
+                to=['test@example.com'])
+        finally:
+            tracing.set_tracer(None)
+
+        summary = stats.summary()
+        assert set(summary) == set([
+            'get_context_data', 'render_text_template', 'render_html_template',
+            'inline_css', 'get_message', 'send'])
+        assert summary['render_text_template']['count'] == 1
+        assert summary['render_text_template']['total_size'] == \
+            len('This is a test')
+        # Message-ID and Date headers are generated again when sending
+        assert abs(summary['get_message']['total_size'] -
+                   summary['send']['total_size']) < 10
+
+    def test_sizes_are_in_bytes(self):
+        assert tracing.get_size(u'za\u017c\xf3\u0142\u0107') == 10
+        assert tracing.get_size('abc') == 3
+        assert tracing.get_size(None) is None
+
+    def test_errors_are_traced(self):
+        tracer = mock.Mock()
+        tracing.set_tracer(tracer)
+        try:
+            with pytest.raises(IOError):
+                tracing.traced('stage', None, mock.Mock(side_effect=IOError))
+        finally:
+            tracing.set_tracer(None)
+        stage, builder, duration, size, error = tracer.call_args[0]
+        assert (stage, size) == ('stage', None)
+        assert isinstance(error, IOError)
+
+    def test_stats_tracer(self):
+        stats = tracing.StatsTracer(buckets=[0.1, 1])
+        stats('stage', None, 0.05, 10)
+        stats('stage', None, 0.5, None)
+        stats('stage', None, 5, 20, IOError())
+
+        summary = stats.summary()['stage']
+        assert summary['count'] == 3
+        assert summary['min'] == 0.05 and summary['max'] == 5
+        assert summary['total_size'] == 30
+        assert summary['errors'] == 1
+        assert summary['histogram'] == [(0.1, 1), (1, 1), (None, 1)]
+
+        stats.reset()
+        assert stats.summary() == {}
@@ -4,7 +4,8 @@ import pytest
 import premailer
 from django.contrib.sites.models import Site
 from django.core.exceptions import ImproperlyConfigured
-from classymail import utils
+from classymail import inline, utils
+import tests
 
 
 class TestUtils(object):
@@ -13,6 +14,20 @@ class TestUtils(object):
         fn = utils.get_function_by_path('os.path.abspath')
         assert os.path.abspath is fn
 
+    def test_get_function_by_path_is_cached(self):
+        fn = utils.get_function_by_path('os.path.abspath')
+        with mock.patch.object(utils, 'import_module') as m:
+            assert utils.get_function_by_path('os.path.abspath') is fn
+        assert not m.called
+
+    def test_resolved_settings_are_invalidated(self, settings):
+        settings.CLASSYMAIL_URL_FUNCTION = 'tests.custom_url_function'
+        assert utils.get_url_function() is tests.custom_url_function
+        assert utils.get_url_function() is tests.custom_url_function
+
+        settings.CLASSYMAIL_URL_FUNCTION = None
+        assert utils.get_url_function() is None
+
     def test_get_css_inline_function(self, settings):
         # None is useful if you want to deactivate inlining
         settings.CLASSYMAIL_CSS_INLINE_FUNCTION = None
@@ -22,6 +37,23 @@ class TestUtils(object):
         del settings.CLASSYMAIL_CSS_INLINE_FUNCTION
         assert utils.get_css_inline_function() is premailer.transform
 
+    def test_get_css_inliner(self, settings):
+        settings.CLASSYMAIL_CSS_INLINER = 'classymail.inline.FastInliner'
+        settings.CLASSYMAIL_CSS_INLINER_OPTIONS = {'cache_size': 2}
+        inliner = utils.get_css_inline_function()
+        assert isinstance(inliner, inline.FastInliner)
+        assert inliner.stylesheets.maxsize == 2
+        assert utils.get_css_inline_function() is inliner
+
+    def test_get_css_inline_function_with_cache(self, settings):
+        settings.CLASSYMAIL_CSS_INLINE_CACHE = 'default'
+        inliner = utils.get_css_inline_function()
+        assert isinstance(inliner, inline.CachedInliner)
+        assert inliner.inline_fn is premailer.transform
+
+        settings.CLASSYMAIL_CSS_INLINE_FUNCTION = None
+        assert utils.get_css_inline_function() is utils._css_inline_noop
+
     def test_css_inline_noop_function(self):
         expected = object()
         assert utils._css_inline_noop(expected) == expected
@@ -75,6 +107,32 @@ class TestUtils(object):
         # use current site if site param is None (SIDE_ID setting)
         assert utils.get_domain() == 'example.com'
 
+    def test_current_site_cache(self, settings, monkeypatch):
+        get_current = mock.Mock(return_value=Site(domain='spam', name='spam'))
+        monkeypatch.setattr(Site.objects, 'get_current', get_current)
+
+        assert utils.get_site() is utils.get_site()
+        assert get_current.call_count == 1
+
+        settings.SITE_ID = 2
+        utils.get_site()
+        assert get_current.call_count == 2
+
+        utils.clear_site_cache()
+        utils.get_site()
+        assert get_current.call_count == 3
+
+    def test_default_url_function_uses_builder_domain(self):
+        builder = mock.Mock()
+        builder.get_domain.return_value = 'eggs'
+        ret = utils.default_url_function(path='/bar/', builder=builder)
+        assert ret == 'http://eggs/bar/'
+
+        # explicitly passed site wins
+        s = Site(domain='spam', name='spam')
+        ret = utils.default_url_function(path='/bar/', site=s, builder=builder)
+        assert ret == 'http://spam/bar/'
+
     def test_get_domain_override(self, settings):
         """
         Always use CLASSYMAIL_DOMAIN if CLASSYMAIL_OVERRIDE_DOMAIN is True.
@@ -122,3 +180,59 @@ class TestUtils(object):
         # path and object
         assert fn(path='/bar/', site=s) == 'http://spam/bar/'
         assert fn(object=obj, site=s) == 'http://spam/eggs/'
+
+
+class TestUrlBuilder(object):
+    def get_builder(self):
+        from classymail.mixins import SiteMixin
+        return SiteMixin(site=Site(domain='spam', name='spam'))
+
+    def test_build(self):
+        obj = mock.Mock()
+        obj.get_absolute_url.return_value = '/eggs/'
+        url_builder = utils.UrlBuilder(self.get_builder())
+        assert url_builder.build(path='/bar/') == 'http://spam/bar/'
+        assert url_builder.build(object=obj, secure=True) == \
+            'https://spam/eggs/'
+        assert url_builder.build(object=obj) == 'http://spam/eggs/'
+        assert obj.get_absolute_url.call_count == 1
+
+    def test_prefix_is_computed_once(self):
+        builder = self.get_builder()
+        url_builder = utils.UrlBuilder(builder)
+        with mock.patch.object(builder, 'get_domain',
+                               return_value='spam') as get_domain:
+            url_builder.build(path='/a/')
+            url_builder.build(path='/b/')
+        assert get_domain.call_count == 1
+
+        other = Site(domain='eggs', name='eggs')
+        assert url_builder.build(path='/a/', site=other) == 'http://eggs/a/'
+
+    def test_builder_url_builder_is_used(self):
+        builder = self.get_builder()
+        with mock.patch('classymail.utils.default_url_function') as m:
+            url = utils.build_absolute_url(path='/a/', builder=builder)
+        assert url == 'http://spam/a/'
+        assert not m.called
+        assert builder.get_url_builder() is builder.get_url_builder()
+
+    def test_build_many(self):
+        obj = mock.Mock()
+        obj.get_absolute_url.return_value = '/eggs/'
+        url_builder = utils.UrlBuilder(self.get_builder())
+        assert url_builder.build_many(['/a/', obj]) == \
+            ['http://spam/a/', 'http://spam/eggs/']
+
+    def test_build_many_with_custom_function(self, settings):
+        settings.CLASSYMAIL_URL_FUNCTION = 'tests.custom_url_function'
+        url_builder = utils.UrlBuilder(self.get_builder())
+        assert url_builder.build_many(['/a/']) == ['/custom_url/']
+
+        with mock.patch('tests.custom_url_function.build_many',
+                        create=True, return_value=['x', 'y']) as m:
+            url_builder = utils.UrlBuilder(self.get_builder())
+            assert url_builder.build_many(['/a/', '/b/'], secure=True) == \
+                ['x', 'y']
+        m.assert_called_once_with(['/a/', '/b/'], builder=url_builder.builder,
+                                  site=None, secure=True)
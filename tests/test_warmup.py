@@ -0,0 +1,37 @@
+import mock
+from django.contrib.sites.models import Site
+from django.core.management import call_command
+from classymail import base, inline, warmup
+
+
+class TestWarmup(object):
+    def test_registry(self):
+        class RegisteredMail(base.EmailBuilder):
+            pass
+
+        builders = base.get_builders()
+        assert builders['classymail.ClassyMail'].__name__ == 'ClassyMail'
+        assert builders['tests.test_warmup.RegisteredMail'] is RegisteredMail
+
+    def test_warmup(self, settings):
+        settings.CLASSYMAIL_CSS_INLINE_FUNCTION = 'classymail.inline.transform'
+        inline._stylesheets.clear()
+
+        warmed = warmup.warmup()
+        from tests.emails import TestMail
+        assert TestMail in warmed
+        assert len(inline._stylesheets) == 1
+
+        with mock.patch('django.template.loader.get_template') as m:
+            with mock.patch.object(inline, 'Stylesheet') as stylesheet:
+                html = TestMail(extra_context={'text': 'Hi'},
+                                site=Site(domain='test', name='test')) \
+                    .build().alternatives[0][0]
+        assert not m.called and not stylesheet.called
+        assert '<p style="color:red">Hi</p>' in html
+
+    def test_command(self):
+        with mock.patch('classymail.warmup.warmup') as m:
+            m.return_value = []
+            call_command('classymail_warmup')
+        m.assert_called_once_with()